@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class BatchQueueFullError(Exception):
+    """待ち行列が上限に達したときの例外（呼び出し側で503を返す）"""
+
+
+class BatchScheduler:
+    """同時に届いた生成リクエストを1回の推論呼び出しにまとめるスケジューラ
+
+    最初の要素が届いてから `max_wait` 秒、または `max_batch_size` 件に
+    達するまで待ってから `send_batch` にまとめて渡す。`send_batch` は入力と
+    同じ順序で結果を返し、要素ごとの失敗は例外オブジェクトとして返す。
+    その要素の呼び出し元だけが例外を受け取る。
+
+    同時に送信中のバッチは `max_in_flight` 件までとし、上流が詰まっている間は
+    キューに溜めて、`max_queue` を超えた分は `BatchQueueFullError` で断る。
+    """
+
+    def __init__(
+        self,
+        send_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = 8,
+        max_wait: float = 0.02,
+        max_queue: int = 256,
+        max_in_flight: int = 4,
+    ):
+        self.send_batch = send_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_in_flight = max(1, max_in_flight)
+        # キューとセマフォは Python 3.9 では作成時のイベントループに紐づくので、
+        # import 時ではなく最初に使われたときに実行中のループの上で作る
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._queue: "Optional[asyncio.Queue[Tuple[Any, asyncio.Future]]]" = None
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatches: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+        self.rejected = 0
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._worker = None
+            self._dispatches = set()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise BatchQueueFullError("Generation queue is full")
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # 待っている間に切断された呼び出し元は送らない
+        return [(item, future) for item, future in batch if not future.done()]
+
+    async def _run(self) -> None:
+        while True:
+            # 送信枠が空くまでキューから取り出さない（詰まったらキューが埋まる）
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            if not batch:
+                self._slots.release()
+                continue
+            # 送信中も次のバッチを集められるよう、送信は別タスクで行う
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatched)
+
+    def _dispatched(self, task: asyncio.Task) -> None:
+        self._dispatches.discard(task)
+        self._slots.release()
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.send_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch returned {len(results)} results for {len(batch)} inputs")
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} failed: {e!r}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "rejected": self.rejected,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": len(self._dispatches),
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._dispatches):
+            task.cancel()
@@ -0,0 +1,86 @@
+"""マイクロバッチの効果を測るベンチマーク
+
+ローカルのHFスタブに対して、同時に届いた生成リクエストを
+1件ずつ送る場合とBatchSchedulerでまとめる場合の p50/p99 レイテンシと
+上流呼び出し回数を比べる。スタブは呼び出しごとに固定の遅延を持ち、
+上流の同時接続数は --upstream-concurrency で制限する。
+
+    python benchmarks/batch_benchmark.py --callers 256
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import BatchScheduler
+from benchmarks.stub_hf import StubStats, create_app, free_port, serve_in_thread
+from inference import InferenceClient
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run(url, stats, callers, arrival, upstream_concurrency, batch_size, window):
+    client = InferenceClient(url, max_concurrency=upstream_concurrency)
+
+    async def send_single(prompt):
+        result = await client.post({"inputs": prompt})
+        return result[0]["generated_text"]
+
+    async def send_batch(prompts):
+        result = await client.post({"inputs": prompts})
+        return [item[0]["generated_text"] for item in result]
+
+    scheduler = BatchScheduler(send_batch, max_batch_size=batch_size, max_wait=window, max_queue=callers)
+    latencies = []
+
+    async def caller(i):
+        await asyncio.sleep(i * arrival)
+        started = time.perf_counter()
+        if batch_size > 1:
+            await scheduler.submit(f"prompt {i}")
+        else:
+            await send_single(f"prompt {i}")
+        latencies.append(time.perf_counter() - started)
+
+    calls_before = stats.calls
+    await asyncio.gather(*(caller(i) for i in range(callers)))
+    await scheduler.close()
+    await client.close()
+    return latencies, stats.calls - calls_before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callers", type=int, default=256)
+    parser.add_argument("--arrival-ms", type=float, default=1.0, help="呼び出し元の到着間隔")
+    parser.add_argument("--delay", type=float, default=0.2, help="上流呼び出しごとの遅延（秒）")
+    parser.add_argument("--upstream-concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--window-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    stats = StubStats()
+    port = free_port()
+    serve_in_thread(create_app(args.delay, stats), port)
+    url = f"http://127.0.0.1:{port}/models/stub"
+
+    for label, batch_size in (("unbatched", 1), ("batched", args.batch_size)):
+        latencies, calls = asyncio.run(run(
+            url, stats, args.callers, args.arrival_ms / 1000,
+            args.upstream_concurrency, batch_size, args.window_ms / 1000,
+        ))
+        print(
+            f"{label:<10} p50={statistics.median(latencies) * 1000:7.1f}ms "
+            f"p99={percentile(latencies, 0.99) * 1000:7.1f}ms upstream_calls={calls}"
+        )
+
+
+if __name__ == "__main__":
+    main()
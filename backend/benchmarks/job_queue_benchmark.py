@@ -0,0 +1,150 @@
+"""非同期ジョブモードのベンチマーク
+
+ローカルのHFスタブに向けてAPIを起動し、ワーカープロセス数を変えながら
+`/generate-poem?mode=job` にジョブを積む。受付（202）のレイテンシは
+ワーカー数や推論の遅さに関係なく小さいまま、スループットはワーカー数に
+応じて伸びることを確認する。あわせて、1クライアントが大量に積んだ後から
+来た他のクライアントのジョブが待たされないこと（公平性）も見る。
+
+    python benchmarks/job_queue_benchmark.py --delay 0.5 --jobs 96 --levels 1,2,4
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.stub_hf import create_app, free_port, serve_in_thread
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def wait_for(client, url, job_ids):
+    jobs = {}
+    while len(jobs) < len(job_ids):
+        for job_id in job_ids:
+            if job_id in jobs:
+                continue
+            job = (await client.get(f"{url}/jobs/{job_id}")).json()
+            if job["status"] in ("succeeded", "failed"):
+                jobs[job_id] = job
+        await asyncio.sleep(0.1)
+    return jobs
+
+
+async def run_level(url, level, total, heavy_share, rate):
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def submit(client_id, i, delay):
+            await asyncio.sleep(delay)
+            body = {
+                "source": "character",
+                "characterData": {"name": f"ジョブ{level}-{client_id}-{i}", "work": "作品", "traits": "明るい"},
+            }
+            started = time.perf_counter()
+            response = await client.post(
+                f"{url}/generate-poem?mode=job", json=body, headers={"X-Client-Id": client_id}
+            )
+            response.raise_for_status()
+            return client_id, response.json()["job_id"], time.perf_counter() - started
+
+        # 一定のレートで投入する。前半は1クライアントがまとめて積み、
+        # 後半に他のクライアントが少しずつ積む
+        heavy_count = int(total * heavy_share)
+        light_clients = [f"light-{n}" for n in range(4)]
+        client_ids = ["heavy"] * heavy_count + [
+            light_clients[i % len(light_clients)] for i in range(total - heavy_count)
+        ]
+        submitted = await asyncio.gather(*(
+            submit(client_id, i, i / rate) for i, client_id in enumerate(client_ids)
+        ))
+
+        jobs = await wait_for(client, url, [job_id for _, job_id, _ in submitted])
+
+    accept = [seconds for _, _, seconds in submitted]
+    done = [job for job in jobs.values() if job["status"] == "succeeded"]
+    elapsed = max(j["finished_at"] for j in done) - min(j["started_at"] for j in done)
+    waits = {"heavy": [], "light": []}
+    for client_id, job_id, _ in submitted:
+        job = jobs[job_id]
+        waits["heavy" if client_id == "heavy" else "light"].append(job["started_at"] - job["created_at"])
+
+    print(
+        f"workers={level}  accept p50={statistics.median(accept) * 1000:6.1f}ms "
+        f"p99={percentile(accept, 0.99) * 1000:6.1f}ms  throughput={len(done) / elapsed:6.1f} jobs/s  "
+        f"queue wait heavy={statistics.mean(waits['heavy']):5.2f}s light={statistics.mean(waits['light']):5.2f}s  "
+        f"failed={len(jobs) - len(done)}"
+    )
+
+
+def start_workers(processes, concurrency, env):
+    return subprocess.Popen(
+        [sys.executable, "worker.py", "--processes", str(processes), "--concurrency", str(concurrency)],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def warm_up(url):
+    # ワーカーの起動（import や接続）を計測に含めない
+    async with httpx.AsyncClient(timeout=30) as client:
+        response = await client.post(f"{url}/generate-poem?mode=job", json={"source": "character"})
+        await wait_for(client, url, [response.json()["job_id"]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.5, help="スタブの応答遅延（秒）")
+    parser.add_argument("--jobs", type=int, default=96)
+    parser.add_argument("--levels", default="1,2,4", help="ワーカープロセス数")
+    parser.add_argument("--concurrency", type=int, default=4, help="プロセスあたりの並行数")
+    parser.add_argument("--heavy-share", type=float, default=0.75)
+    parser.add_argument("--rate", type=float, default=50, help="ジョブの投入レート（件/秒）")
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    serve_in_thread(create_app(args.delay), stub_port)
+
+    workdir = tempfile.mkdtemp(prefix="job-bench-")
+    os.environ.update({
+        "HF_API_URL": f"http://127.0.0.1:{stub_port}/models/stub",
+        "HUGGINGFACE_API_KEY": "stub",
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.db"),
+        "SQLITE_PATH": os.path.join(workdir, "poems.db"),
+        "JOB_MAX_PENDING_PER_CLIENT": "0",
+        "JOB_POLL_INTERVAL": "0.05",
+        "LOG_FILE": "",
+        "LOG_LEVEL": "WARNING",
+    })
+    import main as api
+
+    api_port = free_port()
+    serve_in_thread(api.app, api_port)
+    url = f"http://127.0.0.1:{api_port}"
+
+    print(f"stub delay={args.delay}s, jobs per level={args.jobs}, concurrency per worker={args.concurrency}")
+    for level in map(int, args.levels.split(",")):
+        workers = start_workers(level, args.concurrency, os.environ.copy())
+        try:
+            asyncio.run(warm_up(url))
+            asyncio.run(run_level(url, level, args.jobs, args.heavy_share, args.rate))
+        finally:
+            workers.send_signal(signal.SIGTERM)
+            workers.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""/generate-poem の負荷テスト
+
+ローカルのHFスタブに向けてAPIを起動し、同時接続数ごとのスループットを測る。
+推論呼び出しがイベントループをブロックしなければ、同時接続数に応じて
+requests/sec が伸びる。
+
+    python benchmarks/load_test.py --delay 0.2 --requests 128
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_hf import create_app, free_port, serve_in_thread
+
+
+async def run_level(url: str, concurrency: int, total: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=120) as client:
+        async def one(i):
+            # キャッシュに当たらないよう毎回異なるキャラクターにする
+            body = {
+                "source": "character",
+                "characterData": {"name": f"テスト{concurrency}-{i}", "work": "作品", "traits": "明るい"},
+            }
+            async with semaphore:
+                response = await client.post(f"{url}/generate-poem", json=body)
+                response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return total / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.2, help="スタブの応答遅延（秒）")
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--levels", default="1,4,16,64")
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    serve_in_thread(create_app(args.delay), stub_port)
+
+    os.environ["HF_API_URL"] = f"http://127.0.0.1:{stub_port}/models/stub"
+    os.environ.setdefault("HUGGINGFACE_API_KEY", "stub")
+    os.environ.setdefault("HF_MAX_CONCURRENCY", "64")
+    import main as api
+
+    api_port = free_port()
+    serve_in_thread(api.app, api_port)
+    url = f"http://127.0.0.1:{api_port}"
+
+    print(f"stub delay={args.delay}s, requests per level={args.requests}")
+    for level in (int(x) for x in args.levels.split(",")):
+        rps = asyncio.run(run_level(url, level, args.requests))
+        print(f"concurrency={level:>3}  {rps:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""リクエストログ／メトリクスのミドルウェアのオーバーヘッドを測るベンチマーク
+
+ネットワークを介さずASGIアプリを直接呼び、1リクエストあたりの処理時間を
+ミドルウェアなし・従来のログミドルウェア・RequestMetricsMiddleware で比べる。
+従来のミドルウェアはヘッダーをすべてDEBUG/INFOで同期的にファイルへ書く。
+
+    python benchmarks/middleware_overhead.py --requests 5000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, Request
+
+from metrics import RequestMetricsMiddleware, setup_logging
+
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/echo")
+    async def echo(payload: dict):
+        return payload
+
+    return app
+
+
+def with_legacy_logging(app: FastAPI, log_path: str) -> FastAPI:
+    legacy_logger = logging.getLogger("legacy")
+    legacy_logger.propagate = False
+    legacy_logger.setLevel(logging.DEBUG)
+    legacy_logger.addHandler(logging.FileHandler(log_path))
+
+    @app.middleware("http")
+    async def log_requests(request: Request, call_next):
+        legacy_logger.info(f"Request: {request.method} {request.url}")
+        legacy_logger.info(f"Headers: {dict(request.headers)}")
+        content_length = request.headers.get("content-length")
+        if content_length:
+            legacy_logger.info(f"Request body: {content_length} bytes")
+        return await call_next(request)
+
+    return app
+
+
+async def drive(app, requests: int) -> float:
+    body = b'{"name": "test", "traits": "bright"}'
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/echo",
+        "raw_path": b"/echo",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"user-agent", b"bench"),
+        ],
+        "client": ("127.0.0.1", 1234),
+        "server": ("bench", 80),
+    }
+
+    never = asyncio.Event()
+
+    async def call():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # ボディ送信後は切断されるまで待つ
+            await never.wait()
+
+        async def send(message):
+            pass
+
+        await app(dict(scope), receive, send)
+
+    # ウォームアップ
+    for _ in range(100):
+        await call()
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call()
+    return (time.perf_counter() - started) / requests * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_logging("INFO", os.path.join(tmp, "app.log"), console=False)
+
+        variants = {
+            "none": create_app(),
+            "legacy": with_legacy_logging(create_app(), os.path.join(tmp, "legacy.log")),
+            "metrics": RequestMetricsMiddleware(create_app(), sample_rate=0.1),
+        }
+        results = {name: asyncio.run(drive(app, args.requests)) for name, app in variants.items()}
+
+    baseline = results["none"]
+    for name, per_request in results.items():
+        print(f"{name:<8} {per_request:8.1f} us/request  overhead={per_request - baseline:+7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""推論ルーターの効果を測るベンチマーク
+
+503（model loading）と遅い応答を混ぜたHFスタブと、安定したOpenAI互換スタブを
+ローカルで起動し、HFだけを直接呼ぶ場合とルーター（サーキットブレーカー・
+再試行・ヘッジ）経由の場合で、成功率・p50/p99・ルーティングの内訳を比べる。
+
+    python benchmarks/router_benchmark.py --requests 300
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_hf import StubStats, create_app, free_port, serve_in_thread
+from inference import InferenceClient, InferenceError
+from inference_router import HuggingFaceBackend, InferenceRouter, OpenAICompatibleBackend
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run(label, hf_url, openai_url, requests, concurrency, routed):
+    decisions = Counter()
+    hf_client = InferenceClient(hf_url, max_concurrency=concurrency)
+    backends = [HuggingFaceBackend(hf_client)]
+    if routed:
+        backends.append(OpenAICompatibleBackend(openai_url, "stub"))
+    router = InferenceRouter(
+        backends,
+        max_attempts=3 if routed else 1,
+        backoff_base=0.05,
+        hedge_ratio=0.1 if routed else 0.0,
+        failure_threshold=5,
+        reset_timeout=2.0,
+        on_decision=lambda decision, backend: decisions.update([f"{decision}:{backend}"]),
+    )
+
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await router.generate(f"prompt {i}", {})
+                latencies.append(time.perf_counter() - started)
+            except InferenceError:
+                errors += 1
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    await router.close()
+    await hf_client.close()
+
+    print(
+        f"{label:<8} success={len(latencies) / requests:6.1%} "
+        f"p50={statistics.median(latencies) * 1000:7.1f}ms p99={percentile(latencies, 0.99) * 1000:7.1f}ms "
+        f"hedges={router.hedges}"
+    )
+    print(f"         decisions: {dict(sorted(decisions.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--fail-rate", type=float, default=0.15)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    hf_port, openai_port = free_port(), free_port()
+    serve_in_thread(create_app(0.05, StubStats(), args.fail_rate, args.slow_rate, slow_delay=1.0), hf_port)
+    serve_in_thread(create_app(0.08, StubStats()), openai_port)
+    hf_url = f"http://127.0.0.1:{hf_port}/models/stub"
+    openai_url = f"http://127.0.0.1:{openai_port}/v1"
+
+    asyncio.run(run("direct", hf_url, openai_url, args.requests, args.concurrency, routed=False))
+    asyncio.run(run("routed", hf_url, openai_url, args.requests, args.concurrency, routed=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""ベンチマーク用のHugging Face Inference APIスタブ
+
+`inputs` が文字列なら1件、リストならバッチとして応答する。
+`"stream": true` のときはトークンごとにSSEで応答する。
+`/v1/completions` ではOpenAI互換APIとして応答する。
+`fail_rate` / `slow_rate` で 503（model loading）や遅い応答を混ぜられる。
+"""
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class StubStats:
+    def __init__(self):
+        self.calls = 0
+        self.prompts = 0
+        self.streams_completed = 0
+        self.failures = 0
+
+
+def create_app(
+    delay: float = 0.2,
+    stats: StubStats = None,
+    fail_rate: float = 0.0,
+    slow_rate: float = 0.0,
+    slow_delay: float = 2.0,
+) -> Starlette:
+    stats = stats or StubStats()
+
+    async def simulate():
+        """遅延を入れ、失敗させる場合は503のレスポンスを返す"""
+        await asyncio.sleep(slow_delay if random.random() < slow_rate else delay)
+        if random.random() < fail_rate:
+            stats.failures += 1
+            return JSONResponse({"error": "Model is currently loading", "estimated_time": 20.0}, status_code=503)
+        return None
+
+    async def stream_tokens():
+        tokens = ["星の", "詩を", "\n", "君に"]
+        for i, text in enumerate(tokens):
+            await asyncio.sleep(delay / len(tokens))
+            event = {"token": {"text": text, "special": False}, "generated_text": None}
+            if i == len(tokens) - 1:
+                event["generated_text"] = "".join(tokens)
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        stats.streams_completed += 1
+
+    async def generate(request: Request):
+        payload = await request.json()
+        stats.calls += 1
+        inputs = payload["inputs"]
+        if payload.get("stream"):
+            return StreamingResponse(stream_tokens(), media_type="text/event-stream")
+        failure = await simulate()
+        if failure is not None:
+            return failure
+        if isinstance(inputs, list):
+            stats.prompts += len(inputs)
+            return JSONResponse([[{"generated_text": f"{p}\n星の詩"}] for p in inputs])
+        stats.prompts += 1
+        return JSONResponse([{"generated_text": f"{inputs}\n星の詩"}])
+
+    async def completions(request: Request):
+        try:
+            payload = await request.json()
+        except ClientDisconnect:
+            # ヘッジで負けてキャンセルされた側
+            return Response(status_code=499)
+        stats.calls += 1
+        stats.prompts += 1
+        failure = await simulate()
+        if failure is not None:
+            return failure
+        return JSONResponse({
+            "id": f"cmpl-{stats.calls}",
+            "object": "text_completion",
+            "created": 0,
+            "model": payload["model"],
+            "choices": [{"text": "\n星の詩", "index": 0, "finish_reason": "stop", "logprobs": None}],
+        })
+
+    app = Starlette(routes=[
+        Route("/models/stub", generate, methods=["POST"]),
+        Route("/v1/completions", completions, methods=["POST"]),
+    ])
+    app.state.stats = stats
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
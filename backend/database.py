@@ -0,0 +1,215 @@
+import asyncio
+import itertools
+import logging
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# SQLite と PostgreSQL で型の書き方だけが異なるため、テンプレートを共有する
+SCHEMA_TEMPLATE = """
+CREATE TABLE IF NOT EXISTS characters (
+    id {pk},
+    name TEXT NOT NULL,
+    work TEXT NOT NULL,
+    traits TEXT NOT NULL,
+    quotes TEXT,
+    created_at {ts} NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS poems (
+    id {pk},
+    character_id INTEGER REFERENCES characters(id) ON DELETE SET NULL,
+    source TEXT NOT NULL,
+    content TEXT NOT NULL,
+    image_url TEXT,
+    rating_count INTEGER NOT NULL DEFAULT 0,
+    rating_score INTEGER NOT NULL DEFAULT 0,
+    share_count INTEGER NOT NULL DEFAULT 0,
+    created_at {ts} NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at {ts} NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 人気順フィードのキーセットページング用
+CREATE INDEX IF NOT EXISTS idx_poems_popular ON poems (rating_score DESC, id DESC);
+
+CREATE TABLE IF NOT EXISTS ratings (
+    id {pk},
+    poem_id INTEGER NOT NULL REFERENCES poems(id) ON DELETE CASCADE,
+    rating INTEGER NOT NULL,
+    created_at {ts} NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ratings_poem_id ON ratings (poem_id);
+"""
+
+SQLITE_SCHEMA = SCHEMA_TEMPLATE.format(pk="INTEGER PRIMARY KEY AUTOINCREMENT", ts="TEXT")
+POSTGRES_SCHEMA = SCHEMA_TEMPLATE.format(pk="SERIAL PRIMARY KEY", ts="TIMESTAMPTZ")
+
+
+class Connection:
+    """トランザクション内で使う接続の共通インターフェース（プレースホルダは `?`）"""
+
+    async def fetch(self, sql: str, *args: Any) -> List[dict]:
+        raise NotImplementedError
+
+    async def fetchrow(self, sql: str, *args: Any) -> Optional[dict]:
+        rows = await self.fetch(sql, *args)
+        return rows[0] if rows else None
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        raise NotImplementedError
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]) -> None:
+        raise NotImplementedError
+
+
+class _SQLiteConnection(Connection):
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def _fetch(self, sql: str, args: Sequence[Any]) -> List[dict]:
+        cursor = self._conn.execute(sql, args)
+        columns = [c[0] for c in cursor.description or ()]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    async def fetch(self, sql: str, *args: Any) -> List[dict]:
+        return await asyncio.to_thread(self._fetch, sql, args)
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        await asyncio.to_thread(self._conn.execute, sql, args)
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]) -> None:
+        await asyncio.to_thread(self._conn.executemany, sql, rows)
+
+
+class SQLiteDatabase:
+    """ローカル実行・テスト用の SQLite 実装
+
+    接続をキューで使い回す小さなプールを持ち、クエリはスレッドで実行して
+    イベントループをブロックしない。
+    """
+
+    dialect = "sqlite"
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        # :memory: は接続ごとに別のDBになるため1接続に限る
+        self.pool_size = 1 if path == ":memory:" else pool_size
+        self._pool: Optional[asyncio.Queue] = None
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    async def connect(self) -> None:
+        self._pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._pool.put_nowait(await asyncio.to_thread(self._open))
+        conn = await self._pool.get()
+        try:
+            await asyncio.to_thread(conn.executescript, SQLITE_SCHEMA)
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        """読み取り用（トランザクションを張らない）"""
+        conn = await self._pool.get()
+        try:
+            yield _SQLiteConnection(conn)
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Connection]:
+        conn = await self._pool.get()
+        try:
+            await asyncio.to_thread(conn.execute, "BEGIN IMMEDIATE")
+            try:
+                yield _SQLiteConnection(conn)
+            except BaseException:
+                await asyncio.to_thread(conn.execute, "ROLLBACK")
+                raise
+            await asyncio.to_thread(conn.execute, "COMMIT")
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def close(self) -> None:
+        if self._pool is None:
+            return
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._pool = None
+
+
+_PLACEHOLDER = re.compile(r"\?")
+
+
+def _to_postgres(sql: str) -> str:
+    counter = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda _: f"${next(counter)}", sql)
+
+
+class _PostgresConnection(Connection):
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def fetch(self, sql: str, *args: Any) -> List[dict]:
+        return [dict(row) for row in await self._conn.fetch(_to_postgres(sql), *args)]
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        await self._conn.execute(_to_postgres(sql), *args)
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]) -> None:
+        await self._conn.executemany(_to_postgres(sql), rows)
+
+
+class PostgresDatabase:
+    """asyncpg のコネクションプールを使う PostgreSQL 実装"""
+
+    dialect = "postgres"
+
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    async def connect(self) -> None:
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        async with self._pool.acquire() as conn:
+            await conn.execute(POSTGRES_SCHEMA)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        """読み取り用（トランザクションを張らない）"""
+        async with self._pool.acquire() as conn:
+            yield _PostgresConnection(conn)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Connection]:
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                yield _PostgresConnection(conn)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+def create_database(url: Optional[str], sqlite_path: str = "poems.db", pool_min: int = 2, pool_max: int = 10):
+    """DATABASE_URL から実装を選ぶ（未設定なら SQLite にフォールバック）"""
+    if url and url.startswith(("postgres://", "postgresql://")):
+        return PostgresDatabase(url, min_size=pool_min, max_size=pool_max)
+    if url and url.startswith("sqlite:///"):
+        return SQLiteDatabase(url[len("sqlite:///"):])
+    return SQLiteDatabase(sqlite_path)
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceError(Exception):
+    """推論APIの呼び出しに失敗したときの例外"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class InferenceClient:
+    """キープアライブ接続を共有する非同期の推論APIクライアント
+
+    プロセス全体で1つのコネクションプールを使い回し、同時実行数を
+    セマフォで制限する。イベントループをブロックしない。
+    `on_complete` を渡すと、呼び出しごとに結果（ok / timeout / error /
+    http_error）と所要秒数で呼ばれる。
+    """
+
+    def __init__(
+        self,
+        url: str,
+        api_key: Optional[str] = None,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_concurrency: int = 16,
+        max_keepalive: int = 16,
+        on_complete: Optional[Callable[[str, float], None]] = None,
+    ):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_concurrency = max_concurrency
+        self.limits = httpx.Limits(
+            max_connections=max_concurrency,
+            max_keepalive_connections=max_keepalive,
+        )
+        # Python 3.9 のセマフォは作成時のループに紐づくので、使うループの上で作る
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.on_complete = on_complete
+
+    def _record(self, outcome: str, started: float) -> None:
+        if self.on_complete is not None:
+            self.on_complete(outcome, time.perf_counter() - started)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # 起動イベントを経由しない場合（スクリプトなど）に備えて遅延生成する
+        if self._client is None or self._client.is_closed:
+            headers = {}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(
+                headers=headers,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._client
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def start(self) -> None:
+        self._get_client()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _request_timeout(self, timeout: Optional[float]) -> httpx.Timeout:
+        if timeout:
+            return httpx.Timeout(timeout, connect=self.timeout.connect)
+        return self.timeout
+
+    async def post(self, payload: dict, timeout: Optional[float] = None) -> Any:
+        client = self._get_client()
+        request_timeout = self._request_timeout(timeout)
+
+        async with self._get_semaphore():
+            started = time.perf_counter()
+            try:
+                response = await client.post(self.url, json=payload, timeout=request_timeout)
+            except httpx.TimeoutException as e:
+                self._record("timeout", started)
+                logger.warning(f"Inference request timed out: {e!r}")
+                raise InferenceError(504, "Inference request timed out")
+            except httpx.HTTPError as e:
+                self._record("error", started)
+                logger.error(f"Inference request failed: {e!r}")
+                raise InferenceError(502, "Inference request failed")
+
+        if response.status_code != 200:
+            self._record("http_error", started)
+            logger.error(f"Inference API returned {response.status_code}: {response.text[:200]}")
+            raise InferenceError(response.status_code, "Failed to generate text")
+
+        try:
+            result = response.json()
+        except ValueError:
+            # 200 でも HTML のエラーページなどが返ることがある
+            self._record("error", started)
+            logger.error(f"Inference API returned a non-JSON body: {response.text[:200]}")
+            raise InferenceError(502, "Malformed generation response")
+        self._record("ok", started)
+        return result
+
+    async def stream(self, payload: dict, timeout: Optional[float] = None) -> AsyncIterator[dict]:
+        """`"stream": true` の応答（SSE）をイベントごとに返す
+
+        途中で反復を止めると上流の接続を閉じ、生成も打ち切られる。
+        ストリーミング非対応で通常のJSONが返った場合は1イベントにまとめて返す。
+        """
+        client = self._get_client()
+        request_timeout = self._request_timeout(timeout)
+
+        async with self._get_semaphore():
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                async with client.stream("POST", self.url, json=payload, timeout=request_timeout) as response:
+                    if response.status_code != 200:
+                        outcome = "http_error"
+                        body = await response.aread()
+                        logger.error(f"Inference API returned {response.status_code}: {body[:200]!r}")
+                        raise InferenceError(response.status_code, "Failed to generate text")
+
+                    if response.headers.get("content-type", "").startswith("application/json"):
+                        result = json.loads(await response.aread())
+                        item = result[0] if isinstance(result, list) else result
+                        yield {"token": {"text": item["generated_text"]}}
+                        return
+
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data:
+                            yield json.loads(data)
+            except httpx.TimeoutException as e:
+                outcome = "timeout"
+                logger.warning(f"Inference stream timed out: {e!r}")
+                raise InferenceError(504, "Inference request timed out")
+            except httpx.HTTPError as e:
+                outcome = "error"
+                logger.error(f"Inference stream failed: {e!r}")
+                raise InferenceError(502, "Inference request failed")
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                outcome = "error"
+                logger.error(f"Inference stream returned a malformed event: {e!r}")
+                raise InferenceError(502, "Malformed generation response")
+            except (asyncio.CancelledError, GeneratorExit):
+                outcome = "cancelled"
+                raise
+            finally:
+                self._record(outcome, started)
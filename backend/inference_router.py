@@ -0,0 +1,417 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+from batching import BatchQueueFullError, BatchScheduler
+from inference import InferenceClient, InferenceError
+
+logger = logging.getLogger(__name__)
+
+# 再試行・別バックエンドへの切り替えの対象にするステータス
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error: InferenceError) -> bool:
+    return error.status_code in RETRYABLE_STATUS
+
+
+class BackendBusyError(InferenceError):
+    """手元の待ち行列が一杯で送れなかった（上流の障害ではないのでブレーカーには数えない）"""
+
+
+class Backend:
+    """推論バックエンドの共通インターフェース"""
+
+    name = "backend"
+
+    async def generate(self, full_prompt: str, parameters: dict) -> str:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class HuggingFaceBackend(Backend):
+    """Hugging Face Inference API（503 "model loading" は再試行対象）
+
+    `batch` を渡すとマイクロバッチ経由で送る（バッチの送信パラメータは固定）。
+    クライアントとスケジューラはストリーミングと共有しているため、ここでは閉じない。
+    """
+
+    def __init__(self, client: InferenceClient, batch: Optional[BatchScheduler] = None, name: str = "huggingface"):
+        self.client = client
+        self.batch = batch
+        self.name = name
+
+    async def generate(self, full_prompt: str, parameters: dict) -> str:
+        if self.batch is not None:
+            try:
+                return await self.batch.submit(full_prompt)
+            except BatchQueueFullError as e:
+                # 混雑しているだけなので他のバックエンドに回す
+                raise BackendBusyError(503, str(e))
+
+        result = await self.client.post({"inputs": full_prompt, "parameters": parameters})
+        try:
+            item = result[0] if isinstance(result, list) else result
+            return item["generated_text"]
+        except (KeyError, IndexError, TypeError):
+            raise InferenceError(502, "Malformed generation response")
+
+
+class OpenAICompatibleBackend(Backend):
+    """OpenAI互換API（セルフホストのTGI / vLLM など）の completions エンドポイント"""
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        api_key: Optional[str] = None,
+        timeout: float = 60.0,
+        name: str = "openai-compatible",
+    ):
+        from openai import AsyncOpenAI
+
+        self.name = name
+        self.model = model
+        # 再試行はルーター側で行うのでクライアントの再試行は無効にする
+        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key or "unused", timeout=timeout, max_retries=0)
+
+    async def generate(self, full_prompt: str, parameters: dict) -> str:
+        import openai
+
+        try:
+            completion = await self.client.completions.create(
+                model=self.model,
+                prompt=full_prompt,
+                max_tokens=parameters.get("max_length", 120),
+                temperature=parameters.get("temperature", 0.8),
+                top_p=parameters.get("top_p", 0.95),
+                frequency_penalty=max(0.0, parameters.get("repetition_penalty", 1.0) - 1.0),
+            )
+        except openai.APITimeoutError:
+            raise InferenceError(504, "Inference request timed out")
+        except openai.APIStatusError as e:
+            raise InferenceError(e.status_code, "Failed to generate text")
+        except openai.APIConnectionError:
+            raise InferenceError(502, "Inference request failed")
+
+        if not completion.choices:
+            raise InferenceError(502, "Malformed generation response")
+        return full_prompt + completion.choices[0].text
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class StubBackend(Backend):
+    """外部APIを使わない開発・テスト用のバックエンド"""
+
+    def __init__(self, delay: float = 0.0, name: str = "stub"):
+        self.delay = delay
+        self.name = name
+
+    async def generate(self, full_prompt: str, parameters: dict) -> str:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return f"{full_prompt}\n夜空に浮かぶ言葉たち\nそっと君に届けよう"
+
+
+class CircuitBreaker:
+    """連続失敗で一定時間バックエンドを外すサーキットブレーカー
+
+    `reset_timeout` 経過後は half_open になり、1件だけ試しのリクエストを流す。
+    その結果が出るまでは他のリクエストは流さず、成功すれば閉じ、
+    失敗すればすぐに開き直す。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """今リクエストを送れるか（状態は変えない）"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def acquire(self) -> bool:
+        """実際に送る直前に呼ぶ。half_open では試しの1件の枠を取る"""
+        if not self.allow():
+            return False
+        if self.state == "half_open":
+            self.probing = True
+        return True
+
+    def release(self) -> None:
+        """結果を判定せずに終わった（キャンセル・4xx）場合に枠を返す"""
+        self.probing = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class BackendState:
+    def __init__(self, backend: Backend, breaker: CircuitBreaker, window: int = 200):
+        self.backend = backend
+        self.breaker = breaker
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class InferenceRouter:
+    """複数のバックエンドに振り分ける推論ルーター
+
+    - サーキットブレーカーが開いているバックエンドは使わない（優先度順に選ぶ）
+    - 再試行可能なエラーはジッター付き指数バックオフで再試行し、次の試行では
+      別のバックエンドを優先する
+    - 応答が `hedge_delay`（未指定ならそのバックエンドの p95）を超えたら、
+      別のバックエンドにも同じリクエストを送り、先に返った方を使う。
+      重複送信は全リクエストの `hedge_ratio` 以内に抑える
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        max_attempts: int = 3,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2.0,
+        hedge_delay: Optional[float] = None,
+        hedge_ratio: float = 0.1,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        on_attempt: Optional[Callable[[str, str, float], None]] = None,
+        on_decision: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.states = [
+            BackendState(backend, CircuitBreaker(failure_threshold, reset_timeout))
+            for backend in backends
+        ]
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.hedge_ratio = hedge_ratio
+        self.on_attempt = on_attempt
+        self.on_decision = on_decision
+        self.requests = 0
+        self.hedges = 0
+
+    def _decide(self, decision: str, state: BackendState) -> None:
+        logger.debug(f"Inference routing: {decision} -> {state.backend.name}")
+        if self.on_decision is not None:
+            self.on_decision(decision, state.backend.name)
+
+    def _candidates(self, exclude: Optional[BackendState] = None) -> List[BackendState]:
+        # 優先度順。直前に失敗したバックエンドは後回しにする
+        ordered = [s for s in self.states if s is not exclude]
+        if exclude is not None:
+            ordered.append(exclude)
+        return [s for s in ordered if s.breaker.allow()]
+
+    def _hedge_allowed(self) -> bool:
+        # 1件分のバーストを許しつつ、重複送信の割合を上限以下に保つ
+        if self.hedge_ratio <= 0:
+            return False
+        return self.hedges + 1 <= self.hedge_ratio * self.requests + 1
+
+    def _hedge_after(self, state: BackendState) -> Optional[float]:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        return state.latency_quantile(0.95)
+
+    async def _attempt(self, state: BackendState, full_prompt: str, parameters: dict) -> str:
+        started = time.perf_counter()
+        try:
+            text = await state.backend.generate(full_prompt, parameters)
+        except BackendBusyError:
+            # 手元の混雑はバックエンドの健全性とは関係ないので、枠だけ返して次に回す
+            state.breaker.release()
+            if self.on_attempt is not None:
+                self.on_attempt(state.backend.name, "busy", time.perf_counter() - started)
+            raise
+        except InferenceError as e:
+            elapsed = time.perf_counter() - started
+            if is_retryable(e):
+                state.failures += 1
+                state.breaker.record_failure()
+            else:
+                # 4xx はリクエスト側の問題なのでバックエンドの健全性とは数えない
+                state.breaker.release()
+            if self.on_attempt is not None:
+                self.on_attempt(state.backend.name, "error", elapsed)
+            raise
+        except asyncio.CancelledError:
+            # ヘッジで負けた側。ブレーカーには影響させない（枠は _start で返す）
+            if self.on_attempt is not None:
+                self.on_attempt(state.backend.name, "cancelled", time.perf_counter() - started)
+            raise
+        except Exception as e:
+            # 想定外の例外も失敗として数え（試しの枠もここで返る）、再試行できるエラーにする
+            state.failures += 1
+            state.breaker.record_failure()
+            logger.error(f"Inference backend {state.backend.name} raised {e!r}")
+            if self.on_attempt is not None:
+                self.on_attempt(state.backend.name, "error", time.perf_counter() - started)
+            raise InferenceError(502, "Inference backend failed") from e
+        elapsed = time.perf_counter() - started
+        state.successes += 1
+        state.latencies.append(elapsed)
+        state.breaker.record_success()
+        if self.on_attempt is not None:
+            self.on_attempt(state.backend.name, "ok", elapsed)
+        return text
+
+    @staticmethod
+    def _acquire(candidates: List[BackendState]) -> Optional[BackendState]:
+        # 送る直前に枠を取る（half_open の試しの1件を複数のリクエストで取り合わない）
+        for state in candidates:
+            if state.breaker.acquire():
+                return state
+        return None
+
+    def _start(self, state: BackendState, full_prompt: str, parameters: dict) -> asyncio.Future:
+        task = asyncio.ensure_future(self._attempt(state, full_prompt, parameters))
+        # 開始前にキャンセルされた場合も含め、キャンセル時は試しの枠を返す
+        task.add_done_callback(lambda t: state.breaker.release() if t.cancelled() else None)
+        return task
+
+    async def _hedged(self, candidates: List[BackendState], full_prompt: str, parameters: dict) -> str:
+        primary = self._acquire(candidates)
+        if primary is None:
+            raise InferenceError(503, "No healthy inference backend")
+        self._decide("primary", primary)
+        tasks = [self._start(primary, full_prompt, parameters)]
+
+        hedge_after = self._hedge_after(primary)
+        # 他のバックエンドを優先し、1つだけなら同じバックエンドにヘッジする
+        others = [s for s in candidates if s is not primary]
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done and self._hedge_allowed():
+                    secondary = self._acquire(others + [primary])
+                    if secondary is not None:
+                        self.hedges += 1
+                        self._decide("hedge", secondary)
+                        tasks.append(self._start(secondary, full_prompt, parameters))
+
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def generate(self, full_prompt: str, parameters: dict) -> str:
+        if not self.states:
+            raise InferenceError(500, "Inference backend is not configured")
+
+        self.requests += 1
+        last_failed: Optional[BackendState] = None
+        last_error: Optional[InferenceError] = None
+
+        for attempt in range(self.max_attempts):
+            candidates = self._candidates(last_failed)
+            if not candidates:
+                if self.on_decision is not None:
+                    self.on_decision("unavailable", "none")
+                raise last_error or InferenceError(503, "No healthy inference backend")
+
+            if attempt > 0:
+                self._decide("retry", candidates[0])
+            try:
+                return await self._hedged(candidates, full_prompt, parameters)
+            except InferenceError as e:
+                last_error = e
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                last_failed = candidates[0]
+                # フルジッター付きの指数バックオフ
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+        raise last_error
+
+    def claim(self, name: str) -> Optional[BackendState]:
+        """ルーターを通さずにバックエンドを直接使う（ストリーミング）ときに枠を取る
+
+        half_open なら試しの1件として扱う。取れたら結果を必ず `report` で返す。
+        """
+        for state in self.states:
+            if state.backend.name == name and state.breaker.acquire():
+                return state
+        return None
+
+    def report(self, state: BackendState, elapsed: float, error: Optional[BaseException] = None) -> None:
+        """`claim` で使ったバックエンドの結果をブレーカーに反映する"""
+        if error is None:
+            # ストリーミングの所要時間はクライアントの読み取りにも左右されるので、ヘッジ用の分布には入れない
+            state.successes += 1
+            state.breaker.record_success()
+            outcome = "ok"
+        elif isinstance(error, InferenceError) and is_retryable(error) and not isinstance(error, BackendBusyError):
+            state.failures += 1
+            state.breaker.record_failure()
+            outcome = "error"
+        else:
+            # 切断・4xx はバックエンドの健全性とは数えない
+            state.breaker.release()
+            outcome = "error" if isinstance(error, InferenceError) else "cancelled"
+        if self.on_attempt is not None:
+            self.on_attempt(state.backend.name, outcome, elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "backends": [
+                {
+                    "name": s.backend.name,
+                    "state": s.breaker.state,
+                    "successes": s.successes,
+                    "failures": s.failures,
+                    "p50_ms": (s.latency_quantile(0.5) or 0) * 1000,
+                    "p95_ms": (s.latency_quantile(0.95) or 0) * 1000,
+                }
+                for s in self.states
+            ],
+        }
+
+    async def close(self) -> None:
+        for state in self.states:
+            await state.backend.close()
@@ -0,0 +1,292 @@
+import ipaddress
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Collection, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    callback_url TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_until REAL,
+    worker_id TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+
+-- 取り出し対象（queued）の絞り込みと、リース切れの検出用
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority DESC, available_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client_id, status);
+
+-- クライアントごとに最後にジョブを取り出した時刻（公平なスケジューリング用）
+CREATE TABLE IF NOT EXISTS job_clients (
+    client_id TEXT PRIMARY KEY,
+    last_served REAL NOT NULL
+);
+"""
+
+# 最後に処理された時刻が古いクライアントから取り出す。優先度はクライアントが
+# 自分で指定できるので、クライアント間ではなく同じクライアントのジョブの順番にだけ使う
+CLAIM_SQL = """
+SELECT j.id FROM jobs j
+LEFT JOIN job_clients c ON c.client_id = j.client_id
+WHERE j.status = 'queued' AND j.available_at <= ?
+ORDER BY COALESCE(c.last_served, 0) ASC, j.priority DESC, j.created_at ASC
+LIMIT 1
+"""
+
+FINISHED_STATUSES = ("succeeded", "failed")
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class CallbackURLError(ValueError):
+    pass
+
+
+def check_callback_url(url: str, allowed_hosts: Collection[str] = ()) -> List[str]:
+    """callback_url が内部のアドレスを指していないか確認する（SSRF対策）
+
+    `allowed_hosts` があればそのホストだけを許可する。なければ名前解決して、
+    プライベート・ループバック・リンクローカルなどグローバルでないアドレスを拒否し、
+    確認したアドレスを返す（送信時はこのアドレスに接続する）。
+    名前解決を伴うので、イベントループからは `asyncio.to_thread` で呼ぶ。
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise CallbackURLError("callback_url には http(s) のURLを指定してください")
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise CallbackURLError(f"callback_url のホスト {host} は許可されていません")
+        return []
+
+    try:
+        infos = socket.getaddrinfo(host, parts.port or 443, type=socket.SOCK_STREAM)
+    except (socket.gaierror, ValueError) as e:
+        raise CallbackURLError(f"callback_url のホスト {host} を解決できません") from e
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise CallbackURLError(f"callback_url のホスト {host} は内部のアドレスを指しています")
+        addresses.append(str(address))
+    return addresses
+
+
+class JobQueue:
+    """SQLite に保存する永続的なジョブキュー
+
+    APIプロセスとワーカープロセスが同じファイルを共有する。取り出したジョブには
+    リースを付け、ワーカーが落ちてリースが切れたジョブはキューに戻す。
+    メソッドは同期なので、イベントループからは `asyncio.to_thread` で呼ぶ。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 3,
+        max_pending_per_client: int = 20,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_pending_per_client = max_pending_per_client
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL では NORMAL でもプロセスが落ちたときのコミットは失われない
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(JOB_SCHEMA)
+        self._lock = threading.Lock()
+        # 集計は /metrics からイベントループ上で呼ばれるので、書き込み側のロックや
+        # BEGIN IMMEDIATE を待たない別の読み取り専用接続を使う（WAL では読み取りは書き込みを待たない）
+        self._stats_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._stats_conn.execute("PRAGMA query_only=ON")
+        self._stats_conn.execute("PRAGMA busy_timeout=100")
+        self._stats_lock = threading.Lock()
+
+    def _write(self, fn):
+        """書き込みは BEGIN IMMEDIATE で他プロセスと直列化する"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, payload: dict, client_id: str, priority: int = 0, callback_url: Optional[str] = None) -> dict:
+        def insert(conn):
+            if self.max_pending_per_client > 0:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE client_id = ? AND status IN ('queued', 'running')",
+                    (client_id,),
+                ).fetchone()[0]
+                if pending >= self.max_pending_per_client:
+                    raise JobQueueFullError("処理待ちのジョブが多すぎます")
+            now = time.time()
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, client_id, priority, status, payload, callback_url, available_at, created_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, client_id, priority, json.dumps(payload, ensure_ascii=False), callback_url, now, now),
+            )
+            return job_id
+
+        return self.get(self._write(insert))
+
+    def _requeue_expired(self, conn, now: float) -> None:
+        # リース切れ（ワーカーの停止・再デプロイ）のジョブを戻す
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Job lease expired too many times', finished_at = ? "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, now, self.max_attempts),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', worker_id = NULL, lease_until = NULL "
+            "WHERE status = 'running' AND lease_until < ?",
+            (now,),
+        )
+
+    def _has_work(self, now: float) -> bool:
+        # 空振りのポーリングで書き込みロックを取らないよう、先に読み取りだけで確認する
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM jobs WHERE (status = 'queued' AND available_at <= ?) "
+                "OR (status = 'running' AND lease_until < ?) LIMIT 1",
+                (now, now),
+            ).fetchone() is not None
+
+    def claim(self, worker_id: str) -> Optional[dict]:
+        """次に処理するジョブを1件取り出す（なければ None）"""
+        if not self._has_work(time.time()):
+            return None
+
+        def pick(conn):
+            now = time.time()
+            self._requeue_expired(conn, now)
+            row = conn.execute(CLAIM_SQL, (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_id = ?, "
+                "lease_until = ?, started_at = ? WHERE id = ?",
+                (worker_id, now + self.lease_seconds, now, row["id"]),
+            )
+            conn.execute(
+                "INSERT INTO job_clients (client_id, last_served) "
+                "SELECT client_id, ? FROM jobs WHERE id = ? "
+                "ON CONFLICT (client_id) DO UPDATE SET last_served = excluded.last_served",
+                (now, row["id"]),
+            )
+            return row["id"]
+
+        job_id = self._write(pick)
+        return self.get(job_id) if job_id else None
+
+    def complete(self, job_id: str, result: dict) -> None:
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, lease_until = NULL, finished_at = ? "
+            "WHERE id = ?",
+            (json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id),
+        ))
+
+    def fail(self, job_id: str, error: str, retry_after: Optional[float] = None) -> bool:
+        """失敗を記録する。`retry_after` があり試行回数が残っていれば再投入して True を返す"""
+        def update(conn):
+            attempts = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            now = time.time()
+            if retry_after is not None and attempts < self.max_attempts:
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, worker_id = NULL, lease_until = NULL, "
+                    "available_at = ? WHERE id = ?",
+                    (error, now + retry_after, job_id),
+                )
+                return True
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, finished_at = ? WHERE id = ?",
+                (error, now, job_id),
+            )
+            return False
+
+        return self._write(update)
+
+    def release(self, job_id: str) -> None:
+        """ワーカーの停止時に処理中のジョブを試行回数を戻してキューに返す"""
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), worker_id = NULL, "
+            "lease_until = NULL WHERE id = ? AND status = 'running'",
+            (job_id,),
+        ))
+
+    def purge(self, older_than: float) -> int:
+        """終了から `older_than` 秒以上経ったジョブを消す"""
+        cutoff = time.time() - older_than
+        return self._write(lambda conn: conn.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+            (*FINISHED_STATUSES, cutoff),
+        ).rowcount)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            rows = self._stats_conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in ("queued", "running", *FINISHED_STATUSES)}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        with self._stats_lock:
+            self._stats_conn.close()
+
+
+def public_job(job: dict) -> dict:
+    """APIやコールバックで返すジョブの表現（ペイロードや内部の管理項目は含めない）"""
+    body = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "priority": job["priority"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+    if job["status"] == "succeeded":
+        body["poem"] = job["result"]
+    elif job["error"]:
+        body["error"] = job["error"]
+    return body
@@ -1,42 +1,68 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import AsyncIterator, List, Optional, Union
 import os
+import time
+import asyncio
 from dotenv import load_dotenv
-import requests
-import shutil
-from datetime import datetime
 import logging
-import sys
-import json
 from fastapi.security import APIKeyHeader
 from fastapi import Security
-
-# ロギングの設定
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('app.log')
-    ]
+from inference import InferenceClient, InferenceError
+from inference_router import (
+    HuggingFaceBackend,
+    InferenceRouter,
+    OpenAICompatibleBackend,
+    StubBackend,
+    is_retryable,
+)
+from poem_cache import PoemCache, SQLiteCacheBackend, make_cache_key
+from batching import BatchScheduler, BatchQueueFullError
+from streaming import StreamMetrics, StreamTimer, sse_event
+from uploads import UploadError, UploadStore
+from storage import create_storage
+from database import create_database
+from poem_store import InvalidCursorError, PoemNotFoundError, PoemStore, parse_rating
+from jobs import CallbackURLError, JobQueue, JobQueueFullError, check_callback_url, public_job
+from metrics import (
+    RequestMetricsMiddleware,
+    record_backend_attempt,
+    record_routing_decision,
+    record_upstream,
+    registry,
+    setup_logging,
+    stream_duration,
+    stream_ttfb,
 )
-
-logger = logging.getLogger(__name__)
 
 # 環境変数の読み込み
 load_dotenv()
 
+# ロギングの設定（出力はキュー経由で別スレッドから行う）
+setup_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FILE', 'app.log') or None)
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="ポエム生成API")
 
 # アップロードディレクトリの作成
 UPLOAD_DIR = "uploads"
+UPLOAD_TMP_DIR = os.getenv('UPLOAD_TMP_DIR', os.path.join(UPLOAD_DIR, ".incoming"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# 静的ファイルのマウント
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# 保存先の選択（AWS_S3_BUCKET が設定されていればS3互換ストレージ）
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND') or ('s3' if os.getenv('AWS_S3_BUCKET') else 'local')
+storage = create_storage(STORAGE_BACKEND, UPLOAD_DIR)
+
+# アップロード画像の保存（縮小版の作成はワーカースレッドで行う）
+upload_store = UploadStore(storage, UPLOAD_TMP_DIR, workers=int(os.getenv('THUMBNAIL_WORKERS', '2')))
+
+# アップロード画像の配信（S3の場合は署名付きURLへリダイレクト）
+@app.get("/uploads/{key:path}")
+async def serve_upload(key: str):
+    return await storage.response_for(key)
 
 # CORSの設定
 origins = [
@@ -54,61 +80,202 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
-# リクエストログミドルウェア
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info(f"Request: {request.method} {request.url}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    
-    try:
-        body = await request.body()
-        if body:
-            logger.info(f"Request body: {body.decode()}")
-    except Exception as e:
-        logger.error(f"Error reading request body: {str(e)}")
-    
-    response = await call_next(request)
-    
-    # CORSヘッダーの追加
-    origin = request.headers.get("origin")
-    if origin in origins:
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "*"
-    
-    return response
+# リクエストのメトリクス・サンプリングログ（ボディのログは既定で無効）
+app.add_middleware(
+    RequestMetricsMiddleware,
+    sample_rate=float(os.getenv('LOG_SAMPLE_RATE', '0.1')),
+    slow_threshold=float(os.getenv('LOG_SLOW_THRESHOLD', '1.0')),
+    log_body=os.getenv('LOG_REQUEST_BODY', 'false').lower() == 'true',
+    body_max_bytes=int(os.getenv('LOG_BODY_MAX_BYTES', '1024')),
+)
 
 # Hugging Face APIの設定
-HF_API_URL = "https://api-inference.huggingface.co/models/cyberagent/open-calm-7b"
+HF_API_URL = os.getenv('HF_API_URL', "https://api-inference.huggingface.co/models/cyberagent/open-calm-7b")
 HF_API_KEY = os.getenv('HUGGINGFACE_API_KEY')
+HF_TIMEOUT = float(os.getenv('HF_TIMEOUT', '60'))
+HF_MAX_CONCURRENCY = int(os.getenv('HF_MAX_CONCURRENCY', '16'))
 
-def generate_text(prompt: str) -> str:
-    if not HF_API_KEY:
-        raise HTTPException(status_code=500, detail="Hugging Face API is not configured")
-    
-    headers = {"Authorization": f"Bearer {HF_API_KEY}"}
-    
-    # プロンプトの最適化
-    system_prompt = "あなたは詩人です。以下の条件に基づいて、美しいポエムを生成してください。"
-    full_prompt = f"{system_prompt}\n\n条件：{prompt}\n\nポエム："
-    
+# 推論APIクライアント（コネクションプールはプロセス全体で共有）
+inference_client = InferenceClient(
+    HF_API_URL,
+    api_key=HF_API_KEY,
+    timeout=HF_TIMEOUT,
+    max_concurrency=HF_MAX_CONCURRENCY,
+    on_complete=record_upstream,
+)
+
+def parse_generation(item) -> str:
+    # 単発の応答は [{"generated_text": ...}]、バッチの各要素も同じ形式
+    if isinstance(item, list):
+        item = item[0]
+    return item["generated_text"]
+
+async def generate_batch(full_prompts: List[str]) -> List[Union[str, Exception]]:
     payload = {
-        "inputs": full_prompt,
-        "parameters": {
-            "max_length": 120,
-            "temperature": 0.8,
-            "top_p": 0.95,
-            "repetition_penalty": 1.2,
-            "do_sample": True
-        }
+        "inputs": full_prompts,
+        "parameters": GENERATION_PARAMETERS
     }
+    result = await inference_client.post(payload)
+    if not isinstance(result, list) or len(result) != len(full_prompts):
+        raise InferenceError(502, "Unexpected batch response")
+
+    outputs: List[Union[str, Exception]] = []
+    for item in result:
+        try:
+            outputs.append(parse_generation(item))
+        except (KeyError, IndexError, TypeError):
+            outputs.append(InferenceError(502, "Malformed generation in batch response"))
+    return outputs
+
+# マイクロバッチの設定（HF_BATCH_MAX_SIZE が1のときはバッチ化しない）
+HF_BATCH_MAX_SIZE = int(os.getenv('HF_BATCH_MAX_SIZE', '1'))
+batch_scheduler = BatchScheduler(
+    generate_batch,
+    max_batch_size=HF_BATCH_MAX_SIZE,
+    max_wait=float(os.getenv('HF_BATCH_WINDOW_MS', '20')) / 1000,
+    max_queue=int(os.getenv('HF_BATCH_MAX_QUEUE', '256')),
+    max_in_flight=int(os.getenv('HF_BATCH_MAX_IN_FLIGHT', '4')),
+)
+
+# 推論バックエンドの設定（INFERENCE_BACKENDS の並び順が優先度）
+OPENAI_COMPAT_BASE_URL = os.getenv('OPENAI_COMPAT_BASE_URL')
+INFERENCE_BACKENDS = [
+    name.strip()
+    for name in os.getenv(
+        'INFERENCE_BACKENDS',
+        'huggingface,openai-compatible' if OPENAI_COMPAT_BASE_URL else 'huggingface'
+    ).split(',')
+    if name.strip()
+]
+
+def create_backend(name: str):
+    if name == "huggingface":
+        if not HF_API_KEY:
+            return None
+        # バッチ化してもルーターの再試行・ブレーカー・フェイルオーバーの対象にする
+        return HuggingFaceBackend(inference_client, batch=batch_scheduler if HF_BATCH_MAX_SIZE > 1 else None)
+    if name == "openai-compatible":
+        if not OPENAI_COMPAT_BASE_URL:
+            return None
+        return OpenAICompatibleBackend(
+            OPENAI_COMPAT_BASE_URL,
+            os.getenv('OPENAI_COMPAT_MODEL', 'cyberagent/open-calm-7b'),
+            api_key=os.getenv('OPENAI_COMPAT_API_KEY'),
+            timeout=HF_TIMEOUT,
+        )
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"Unknown inference backend: {name}")
+
+HEDGE_DELAY_MS = os.getenv('INFERENCE_HEDGE_DELAY_MS')
+inference_router = InferenceRouter(
+    [backend for backend in map(create_backend, INFERENCE_BACKENDS) if backend is not None],
+    max_attempts=int(os.getenv('INFERENCE_MAX_ATTEMPTS', '3')),
+    backoff_base=float(os.getenv('INFERENCE_BACKOFF_MS', '200')) / 1000,
+    hedge_delay=float(HEDGE_DELAY_MS) / 1000 if HEDGE_DELAY_MS else None,
+    hedge_ratio=float(os.getenv('INFERENCE_HEDGE_RATIO', '0.1')),
+    failure_threshold=int(os.getenv('INFERENCE_BREAKER_THRESHOLD', '5')),
+    reset_timeout=float(os.getenv('INFERENCE_BREAKER_RESET', '30')),
+    on_attempt=record_backend_attempt,
+    on_decision=record_routing_decision,
+)
+
+# 生成パラメータ（キャッシュキーにも含める）
+GENERATION_PARAMETERS = {
+    "max_length": 120,
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "repetition_penalty": 1.2,
+    "do_sample": True
+}
+
+# 生成結果キャッシュの設定
+POEM_CACHE_PATH = os.getenv('POEM_CACHE_PATH')
+poem_cache = PoemCache(
+    max_entries=int(os.getenv('POEM_CACHE_MAX_ENTRIES', '1024')),
+    max_bytes=int(os.getenv('POEM_CACHE_MAX_BYTES', str(16 * 1024 * 1024))),
+    ttl=float(os.getenv('POEM_CACHE_TTL', '3600')),
+    variants=int(os.getenv('POEM_CACHE_VARIANTS', '3')),
+    backend=SQLiteCacheBackend(POEM_CACHE_PATH) if POEM_CACHE_PATH else None,
+)
+
+# データベース（DATABASE_URL が未設定なら SQLite）
+database = create_database(
+    os.getenv('DATABASE_URL'),
+    sqlite_path=os.getenv('SQLITE_PATH', 'poems.db'),
+    pool_min=int(os.getenv('DATABASE_POOL_MIN', '2')),
+    pool_max=int(os.getenv('DATABASE_POOL_MAX', '10')),
+)
+poem_store = PoemStore(database)
+
+# 評価の書き込みはまとめて1トランザクションで行う
+rating_scheduler = BatchScheduler(
+    poem_store.add_ratings,
+    max_batch_size=int(os.getenv('RATING_BATCH_MAX_SIZE', '64')),
+    max_wait=float(os.getenv('RATING_BATCH_WINDOW_MS', '50')) / 1000,
+    max_queue=int(os.getenv('RATING_BATCH_MAX_QUEUE', '1024')),
+    max_in_flight=int(os.getenv('RATING_BATCH_MAX_IN_FLIGHT', '2')),
+)
+
+# 非同期ジョブモードのキュー（ワーカーは worker.py で別プロセスとして起動する）
+job_queue = JobQueue(
+    os.getenv('JOB_QUEUE_PATH', 'jobs.db'),
+    lease_seconds=float(os.getenv('JOB_LEASE_SECONDS', '300')),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+    max_pending_per_client=int(os.getenv('JOB_MAX_PENDING_PER_CLIENT', '20')),
+)
+# 空ならグローバルなアドレスへのコールバックをすべて許可する
+JOB_CALLBACK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv('JOB_CALLBACK_ALLOWED_HOSTS', '').split(',') if h.strip()}
+
+@app.on_event("startup")
+async def startup():
+    await database.connect()
+    await inference_client.start()
+    await poem_cache.load()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await batch_scheduler.close()
+    await rating_scheduler.close()
+    await inference_router.close()
+    await inference_client.close()
+    await database.close()
+    poem_cache.close()
+    upload_store.close()
+    job_queue.close()
+
+def build_full_prompt(prompt: str) -> str:
+    # プロンプトの最適化
+    system_prompt = "あなたは詩人です。以下の条件に基づいて、美しいポエムを生成してください。"
+    return f"{system_prompt}\n\n条件：{prompt}\n\nポエム："
+
+def strip_prompt(full_prompt: str, text: str) -> str:
+    # キャッシュには同期版と同じ「プロンプト + 生成部分」の形で入れる
+    return text[len(full_prompt):] if text.startswith(full_prompt) else text
+
+# ストリーミング生成の TTFB / 合計レイテンシ
+stream_metrics = StreamMetrics()
+
+# 既存の集計を /metrics にも出す
+registry.register_stats("poem_cache", poem_cache.stats)
+registry.register_stats("poem_batch", batch_scheduler.stats)
+registry.register_stats("poem_jobs", job_queue.stats)
+
+async def generate_text(prompt: str) -> str:
+    full_prompt = build_full_prompt(prompt)
     
-    response = requests.post(HF_API_URL, headers=headers, json=payload)
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Failed to generate text")
-    
-    return response.json()[0]["generated_text"]
+    try:
+        # 複数バックエンドへの振り分け・再試行・ヘッジはルーターが行う
+        text = await inference_router.generate(full_prompt, GENERATION_PARAMETERS)
+        if not strip_prompt(full_prompt, text).strip():
+            # 空の結果はキャッシュにも保存にも回さない
+            raise InferenceError(502, "Empty generation")
+        return text
+    except InferenceError as e:
+        if is_retryable(e):
+            # 再試行しても回復しなかった一時的な障害
+            raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": "5"})
+        raise HTTPException(status_code=500, detail=e.detail)
 
 class CharacterInfo(BaseModel):
     name: str
@@ -121,6 +288,13 @@ class PoemRequest(BaseModel):
     character_id: Optional[int] = None
     imageData: Optional[dict] = None
     characterData: Optional[CharacterInfo] = None
+    # 非同期ジョブモード（?mode=job）でのみ使う。priority は同じクライアントのジョブの順番だけを決める
+    priority: int = Field(0, ge=0, le=9)
+    callback_url: Optional[str] = Field(None, pattern=r"^https?://")
+
+class PoemRatingRequest(BaseModel):
+    poem_id: int
+    rating: Union[int, str]  # 1 / -1 または "良い" / "悪い"
 
 class PoemCustomizeRequest(BaseModel):
     poem_id: int
@@ -138,7 +312,7 @@ async def root():
     return {"message": "ポエム生成APIへようこそ"}
 
 @app.post("/upload-photo")
-async def upload_photo(file: UploadFile = File(...)):
+async def upload_photo(request: Request):
     # APIキー認証を一時的に無効化
     # api_key: str = Security(api_key_header)
     # if api_key != os.getenv("API_KEY"):
@@ -147,35 +321,14 @@ async def upload_photo(file: UploadFile = File(...)):
     #         detail="Invalid API key"
     #     )
     try:
-        logger.info(f"Received file upload request: {file.filename}")
+        # ボディを逐次受信し、コンテンツハッシュ名で保存する（同じ画像は1度だけ保存）
+        result = await upload_store.save(request)
         
-        # ファイルサイズの制限を設定
-        if file.size > 5 * 1024 * 1024:  # 5MB制限
-            raise HTTPException(status_code=400, detail="ファイルサイズが大きすぎます")
+        logger.info(f"File uploaded successfully: {result['location']} (duplicate={result['duplicate']})")
         
-        # 許可するファイル形式を制限
-        allowed_types = ["image/jpeg", "image/png", "image/gif"]
-        if file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail="許可されていないファイル形式です")
-        
-        # ファイル名にタイムスタンプを追加して一意にする
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{file.filename}"
-        file_path = os.path.join(UPLOAD_DIR, filename)
-
-        # ファイルを保存
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # ファイルのURLを生成
-        file_url = f"/uploads/{filename}"
-        
-        logger.info(f"File uploaded successfully: {file_url}")
-        
-        return {
-            "filename": filename,
-            "location": file_url
-        }
+        return result
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except Exception as e:
         logger.error(f"Error in upload_photo: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -187,9 +340,12 @@ async def upload_photo(file: UploadFile = File(...)):
 async def submit_character(character: CharacterInfo):
     try:
         logger.info(f"Received character submission: {character.dict()}")
+        saved = await poem_store.create_character(
+            character.name, character.work, character.traits, character.quotes
+        )
         return {
             "message": "キャラクター情報が登録されました",
-            "character": character
+            "character": saved
         }
     except Exception as e:
         logger.error(f"Error in submit_character: {str(e)}", exc_info=True)
@@ -198,53 +354,258 @@ async def submit_character(character: CharacterInfo):
             detail=f"キャラクター情報の登録に失敗しました: {str(e)}"
         )
 
-@app.post("/generate-poem")
-async def generate_poem(request: PoemRequest):
+def build_prompt(request: PoemRequest) -> str:
+    if request.source == "image":
+        # 画像からの生成ロジック
+        return "画像から感じられる雰囲気や感情を表現した、叙情的なポエムを生成してください。"
+    # キャラクター情報からの生成ロジック
+    if request.characterData:
+        return f"以下のキャラクター情報を基に、その世界観を表現したポエムを生成してください。\n名前：{request.characterData.name}\n作品：{request.characterData.work}\n特徴：{request.characterData.traits}\nセリフ：{request.characterData.quotes if request.characterData.quotes else 'なし'}"
+    return "キャラクターの特徴を活かし、その世界観を表現したポエムを生成してください。"
+
+async def save_poem(request: PoemRequest, content: str) -> dict:
+    image_url = (request.imageData or {}).get("location")
+    return await poem_store.create_poem(
+        content,
+        request.source,
+        character_id=request.character_id,
+        image_url=image_url,
+    )
+
+async def create_poem(request: PoemRequest) -> dict:
+    """生成して保存する（同期モードとジョブのワーカーで共通）"""
+    prompt = build_prompt(request)
+    cache_key = make_cache_key(prompt, GENERATION_PARAMETERS)
+    generated_text = await poem_cache.get_or_generate(cache_key, lambda: generate_text(prompt))
+    # ストリーミングと同じく、保存するのはプロンプトを除いた生成部分だけ
+    return await save_poem(request, strip_prompt(build_full_prompt(prompt), generated_text))
+
+def client_id_for(http_request: Request) -> str:
+    # 公平なスケジューリングの単位（ヘッダーがなければ接続元IP）
+    return http_request.headers.get("x-client-id") or (http_request.client.host if http_request.client else "anonymous")
+
+async def enqueue_poem(request: PoemRequest, http_request: Request) -> JSONResponse:
+    payload = request.model_dump(exclude={"priority", "callback_url"})
+    if request.callback_url:
+        try:
+            await asyncio.to_thread(check_callback_url, request.callback_url, JOB_CALLBACK_ALLOWED_HOSTS)
+        except CallbackURLError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     try:
-        if request.source == "image":
-            # 画像からの生成ロジック
-            prompt = "画像から感じられる雰囲気や感情を表現した、叙情的なポエムを生成してください。"
-        else:
-            # キャラクター情報からの生成ロジック
-            if request.characterData:
-                prompt = f"以下のキャラクター情報を基に、その世界観を表現したポエムを生成してください。\n名前：{request.characterData.name}\n作品：{request.characterData.work}\n特徴：{request.characterData.traits}\nセリフ：{request.characterData.quotes if request.characterData.quotes else 'なし'}"
-            else:
-                prompt = "キャラクターの特徴を活かし、その世界観を表現したポエムを生成してください。"
+        job = await asyncio.to_thread(
+            job_queue.enqueue,
+            payload,
+            client_id_for(http_request),
+            priority=request.priority,
+            callback_url=request.callback_url,
+        )
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "10"})
 
-        generated_text = generate_text(prompt)
+    status_url = f"/jobs/{job['id']}"
+    return JSONResponse(
+        {"message": "ポエムの生成を受け付けました", "status_url": status_url, **public_job(job)},
+        status_code=202,
+        headers={"Location": status_url},
+    )
+
+@app.post("/generate-poem")
+async def generate_poem(request: PoemRequest, http_request: Request, mode: str = Query("sync", pattern="^(sync|job)$")):
+    if mode == "job":
+        return await enqueue_poem(request, http_request)
+    try:
+        poem = await create_poem(request)
         
         return {
             "message": "ポエムが生成されました",
-            "poem": {
-                "content": generated_text
-            }
+            "poem": poem
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def stream_tokens(hf, payload: dict) -> AsyncIterator[str]:
+    """HF のストリーミング応答からトークンを取り出し、結果をブレーカーに反映する"""
+    started = time.perf_counter()
+    error: Optional[BaseException] = None
+    try:
+        async for chunk in inference_client.stream(payload):
+            token = chunk.get("token") or {}
+            if token.get("special") or not token.get("text"):
+                continue
+            yield token["text"]
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        inference_router.report(hf, time.perf_counter() - started, error)
+
+@app.post("/generate-poem/stream")
+async def generate_poem_stream(request: PoemRequest):
+    prompt = build_prompt(request)
+    cache_key = make_cache_key(prompt, GENERATION_PARAMETERS)
+    full_prompt = build_full_prompt(prompt)
+    payload = {
+        "inputs": full_prompt,
+        "parameters": GENERATION_PARAMETERS,
+        "stream": True
+    }
+
+    async def events():
+        timer = StreamTimer()
+        try:
+            cached = poem_cache.lookup(cache_key)
+            # ブレーカーの枠を取る（half_open のときは試しの1件だけが HF に流れる）
+            hf = inference_router.claim("huggingface") if cached is None else None
+            if cached is not None:
+                content = strip_prompt(full_prompt, cached)
+                timer.mark_first_byte()
+                yield sse_event("token", {"text": content})
+            elif hf is None:
+                # トークン単位のストリーミングは HF のみ。HF を使わない構成や
+                # ブレーカーが開いているときはルーターで生成して一度に送る
+                text = await generate_text(prompt)
+                content = strip_prompt(full_prompt, text)
+                timer.mark_first_byte()
+                yield sse_event("token", {"text": content})
+                await poem_cache.put(cache_key, text)
+            else:
+                parts = []
+                tokens = stream_tokens(hf, payload)
+                try:
+                    async for text in tokens:
+                        timer.mark_first_byte()
+                        parts.append(text)
+                        yield sse_event("token", {"text": text})
+                finally:
+                    # 切断されたらすぐに上流の接続を閉じる
+                    await tokens.aclose()
+                content = "".join(parts)
+                if not content.strip():
+                    timer.finish("error")
+                    yield sse_event("error", {"detail": "ポエムの生成に失敗しました"})
+                    return
+                await poem_cache.put(cache_key, full_prompt + content)
+
+            poem = await save_poem(request, content)
+            timer.finish()
+            yield sse_event("done", {
+                "id": poem["id"],
+                "content": content,
+                "ttfb_ms": timer.ttfb_ms,
+                "total_ms": timer.total_ms
+            })
+        except (InferenceError, HTTPException) as e:
+            timer.finish("error")
+            yield sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error(f"Error in generate_poem_stream: {str(e)}", exc_info=True)
+            timer.finish("error")
+            yield sse_event("error", {"detail": "ポエムの生成に失敗しました"})
+        except (asyncio.CancelledError, GeneratorExit):
+            # クライアントが切断すると生成を中断し、上流の接続も閉じる
+            timer.finish("cancelled")
+            raise
+        finally:
+            stream_metrics.record(timer)
+            if timer.ttfb_ms is not None:
+                stream_ttfb.observe(timer.ttfb_ms / 1000)
+            stream_duration.observe(timer.total_ms / 1000, status=timer.status)
+            ttfb = f"{timer.ttfb_ms:.1f}ms" if timer.ttfb_ms is not None else "-"
+            logger.info(f"Stream {timer.status}: ttfb={ttfb} total={timer.total_ms:.1f}ms")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/stream-stats")
+async def stream_stats():
+    return stream_metrics.stats()
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/inference-backends")
+async def inference_backends():
+    return inference_router.stats()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return public_job(job)
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return poem_cache.stats()
+
 @app.put("/customize-poem")
 async def customize_poem(request: PoemCustomizeRequest):
     try:
-        # ここでデータベースに保存する処理を実装
+        poem = await poem_store.update_poem_content(request.poem_id, request.content)
         return {
             "message": "ポエムが更新されました",
-            "poem": {
-                "id": request.poem_id,
-                "content": request.content
-            }
+            "poem": poem
+        }
+    except PoemNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/rate-poem")
+async def rate_poem(request: PoemRatingRequest):
+    try:
+        rating = parse_rating(request.rating)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        result = await rating_scheduler.submit((request.poem_id, rating))
+        return {
+            "message": "評価を受け付けました",
+            "rating": result
         }
+    except PoemNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except BatchQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/poems")
+async def list_poems(
+    sort: str = Query("recent", pattern="^(recent|popular)$"),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    try:
+        return await poem_store.list_poems(sort=sort, limit=limit, cursor=cursor)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/poems/{poem_id}")
+async def get_poem(poem_id: int):
+    poem = await poem_store.get_poem(poem_id)
+    if poem is None:
+        raise HTTPException(status_code=404, detail=f"Poem {poem_id} not found")
+    return poem
+
 @app.post("/share-on-sns")
 async def share_on_sns(request: SNSShareRequest):
     try:
+        await poem_store.record_share(request.poem_id)
         # SNS連携の実装
         # 実際のSNS APIとの連携は、各プラットフォームのAPIキーが必要
         return {
             "message": f"{request.platform}への共有が完了しました",
             "share_url": f"https://{request.platform}.com/share/{request.poem_id}"
         }
+    except PoemNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -254,5 +615,5 @@ if __name__ == "__main__":
         app,
         host="0.0.0.0",
         port=8000,
-        log_level="debug"
+        log_level=os.getenv('LOG_LEVEL', 'INFO').lower()
     ) 
\ No newline at end of file
@@ -0,0 +1,256 @@
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("access")
+
+# レイテンシのヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def setup_logging(
+    level: str = "INFO",
+    log_file: Optional[str] = "app.log",
+    console: bool = True,
+) -> logging.handlers.QueueListener:
+    """ログ出力をキュー経由にして、リクエスト処理中にI/Oを待たないようにする"""
+    handlers: List[logging.Handler] = []
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    body = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + body + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def collect(self) -> List[str]:
+        return self.header() + [f"{self.name} {self.value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [バケットごとの件数..., +Inf の件数, 合計]
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self) -> List[str]:
+        lines = self.header()
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Prometheus のテキスト形式で出力するメトリクスの登録先"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Tuple[str, Callable[[], dict]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats: Callable[[], dict]) -> None:
+        """`stats()` が返す数値をゲージとして出力する（キャッシュなどの既存の集計用）"""
+        self._collectors.append((prefix, stats))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for prefix, stats in self._collectors:
+            for name, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{name} gauge")
+                    lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter("http_requests_total", "HTTP requests by route and status"))
+http_latency = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency by route"))
+http_in_flight = registry.register(Gauge("http_requests_in_flight", "HTTP requests currently being served"))
+upstream_latency = registry.register(Histogram("upstream_request_duration_seconds", "Inference API latency by outcome"))
+stream_ttfb = registry.register(Histogram("poem_stream_ttfb_seconds", "Time to first token of streamed poems"))
+stream_duration = registry.register(Histogram("poem_stream_duration_seconds", "Total duration of streamed poems by status"))
+router_attempts = registry.register(Histogram("inference_backend_duration_seconds", "Inference router attempt latency by backend and outcome"))
+router_decisions = registry.register(Counter("inference_routing_decisions_total", "Inference router decisions by backend"))
+
+
+def record_upstream(outcome: str, seconds: float) -> None:
+    upstream_latency.observe(seconds, outcome=outcome)
+
+
+def record_backend_attempt(backend: str, outcome: str, seconds: float) -> None:
+    router_attempts.observe(seconds, backend=backend, outcome=outcome)
+
+
+def record_routing_decision(decision: str, backend: str) -> None:
+    router_decisions.inc(decision=decision, backend=backend)
+
+
+class RequestMetricsMiddleware:
+    """リクエストごとのレイテンシ・処理中件数を記録し、サンプリングしてログに出す
+
+    ASGIミドルウェアとして実装し、レスポンスをバッファしない。ボディのログは
+    既定で無効。有効にした場合も先頭 `body_max_bytes` バイトだけを、
+    multipart 以外のリクエストについて記録する。
+    """
+
+    def __init__(
+        self,
+        app,
+        sample_rate: float = 0.1,
+        slow_threshold: float = 1.0,
+        log_body: bool = False,
+        body_max_bytes: int = 1024,
+    ):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.log_body = log_body
+        self.body_max_bytes = body_max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+        body_sample = bytearray() if self.log_body and not self._is_multipart(scope) else None
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request" and len(body_sample) < self.body_max_bytes:
+                body_sample.extend(message.get("body", b"")[:self.body_max_bytes - len(body_sample)])
+            return message
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive_wrapper if body_sample is not None else receive, send_wrapper)
+        finally:
+            http_in_flight.dec()
+            duration = time.perf_counter() - started
+            route = scope.get("route")
+            # 未定義のパスはラベルをまとめ、系列数が増え続けないようにする
+            route_label = getattr(route, "path", "unmatched")
+            http_latency.observe(duration, route=route_label)
+            http_requests.inc(route=route_label, method=scope["method"], status=str(status["code"]))
+
+            if status["code"] >= 500 or duration >= self.slow_threshold or random.random() < self.sample_rate:
+                entry = {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route_label,
+                    "status": status["code"],
+                    "duration_ms": round(duration * 1000, 2),
+                }
+                if body_sample:
+                    entry["body"] = body_sample.decode("utf-8", errors="replace")
+                access_logger.info(json.dumps(entry, ensure_ascii=False))
+
+    @staticmethod
+    def _is_multipart(scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == b"content-type":
+                return value.startswith(b"multipart/")
+        return False
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(prompt: str, parameters: dict) -> str:
+    """正規化したプロンプトとサンプリングパラメータからキャッシュキーを作る"""
+    normalized = " ".join(unicodedata.normalize("NFKC", prompt).split())
+    material = json.dumps(
+        {"prompt": normalized, "parameters": parameters},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("variants", "created_at", "size")
+
+    def __init__(self, variants: List[str], created_at: float):
+        self.variants = variants
+        self.created_at = created_at
+        self.size = sum(len(v.encode("utf-8")) for v in variants)
+
+
+class SQLiteCacheBackend:
+    """再起動後もキャッシュを温かい状態で始めるためのディスク永続化"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS poem_cache ("
+            "key TEXT PRIMARY KEY, variants TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def load(self) -> Iterable[Tuple[str, List[str], float]]:
+        rows = self._conn.execute(
+            "SELECT key, variants, created_at FROM poem_cache ORDER BY created_at"
+        ).fetchall()
+        for key, variants, created_at in rows:
+            yield key, json.loads(variants), created_at
+
+    def save(self, key: Optional[str], variants: List[str], created_at: float, evicted: Iterable[str] = ()) -> None:
+        """1件の保存と追い出したキーの削除を1回のコミットで行う"""
+        with self._lock:
+            if key is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO poem_cache (key, variants, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(variants, ensure_ascii=False), created_at),
+                )
+            self._conn.executemany("DELETE FROM poem_cache WHERE key = ?", [(k,) for k in evicted])
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class PoemCache:
+    """生成結果のキャッシュ（LRU + TTL、メモリ上限付き）
+
+    1つのキーにつき最大 `variants` 件の生成結果を保持し、揃うまでは
+    ミスとして新しいバリエーションを生成する。同じキーの同時ミスは
+    1回の上流呼び出しにまとめる。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl: float = 3600.0,
+        variants: int = 3,
+        backend: Optional[SQLiteCacheBackend] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.backend = backend
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _store(self, key: str, entry: _Entry) -> List[str]:
+        """追い出したキーを返す（永続化側の削除は呼び出し元がスレッドで行う）"""
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        evicted = []
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            oldest, _ = next(iter(self._entries.items()))
+            self._remove(oldest)
+            self.evictions += 1
+            evicted.append(oldest)
+        return evicted
+
+    async def load(self) -> None:
+        if self.backend is None:
+            return
+        now = time.time()
+        rows = await asyncio.to_thread(lambda: list(self.backend.load()))
+        evicted = []
+        for key, variants, created_at in rows:
+            entry = _Entry(variants[: self.variants], created_at)
+            if self._expired(entry, now):
+                evicted.append(key)
+            else:
+                evicted.extend(self._store(key, entry))
+        if evicted:
+            await asyncio.to_thread(self.backend.save, None, [], now, evicted)
+        logger.info(f"Loaded {len(self._entries)} poem cache entries from {self.backend.path}")
+
+    def get(self, key: str) -> Optional[str]:
+        """バリエーションが揃っていればその中から1件返す"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry, time.time()):
+            self._remove(key)
+            return None
+        if len(entry.variants) < self.variants:
+            return None
+        self._entries.move_to_end(key)
+        return random.choice(entry.variants)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """`get` と同じだが、ヒット／ミスを集計に含める"""
+        cached = self.get(key)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    async def put(self, key: str, text: str) -> None:
+        if not text.strip():
+            # 空の生成結果はキャッシュしない（次のリクエストで作り直す）
+            return
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is None or self._expired(entry, now):
+            variants, created_at = [text], now
+        else:
+            variants, created_at = (entry.variants + [text])[-self.variants:], entry.created_at
+        new_entry = _Entry(variants, created_at)
+        evicted = self._store(key, new_entry)
+        if self.backend is not None:
+            # 大きすぎて自分自身が追い出された場合は evicted に含まれ、削除される
+            stored = key if key in self._entries else None
+            await asyncio.to_thread(self.backend.save, stored, variants, created_at, evicted)
+
+    async def _generate(self, key: str, generate: Callable[[], Awaitable[str]]) -> str:
+        text = await generate()
+        await self.put(key, text)
+        return text
+
+    def _finished(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 待機者がいない場合に "exception was never retrieved" を出さない
+        if not task.cancelled():
+            task.exception()
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]]) -> str:
+        """同じキーの同時ミスは1回の生成にまとめる
+
+        生成はキャッシュが持つタスクで行い、各リクエストは shield して待つ。
+        最初のリクエストが切断されても、他の待機者の生成は中断されない。
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._generate(key, generate))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
@@ -0,0 +1,185 @@
+import base64
+import json
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+POEM_COLUMNS = (
+    "id, character_id, source, content, image_url, rating_count, rating_score, "
+    "share_count, created_at, updated_at"
+)
+
+# フロントエンドは「良い」「悪い」を送ってくる
+RATING_VALUES = {"良い": 1, "悪い": -1, "good": 1, "bad": -1}
+
+
+class PoemNotFoundError(Exception):
+    def __init__(self, poem_id: int):
+        super().__init__(f"Poem {poem_id} not found")
+        self.poem_id = poem_id
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def parse_rating(value: Union[str, int]) -> int:
+    if isinstance(value, int) and value in (-1, 1):
+        return value
+    if isinstance(value, str) and value in RATING_VALUES:
+        return RATING_VALUES[value]
+    raise ValueError(f"Unsupported rating: {value!r}")
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise InvalidCursorError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, int) for v in values):
+        raise InvalidCursorError("Invalid cursor")
+    return values
+
+
+def _placeholders(count: int) -> str:
+    return ", ".join("?" for _ in range(count))
+
+
+class PoemStore:
+    """ポエム・キャラクター・評価の永続化"""
+
+    def __init__(self, database):
+        self.db = database
+
+    async def create_character(self, name: str, work: str, traits: str, quotes: Optional[str]) -> dict:
+        async with self.db.transaction() as conn:
+            return await conn.fetchrow(
+                "INSERT INTO characters (name, work, traits, quotes) VALUES (?, ?, ?, ?) "
+                "RETURNING id, name, work, traits, quotes, created_at",
+                name, work, traits, quotes,
+            )
+
+    async def create_poem(
+        self,
+        content: str,
+        source: str,
+        character_id: Optional[int] = None,
+        image_url: Optional[str] = None,
+    ) -> dict:
+        async with self.db.transaction() as conn:
+            if character_id is not None:
+                exists = await conn.fetchrow("SELECT id FROM characters WHERE id = ?", character_id)
+                if exists is None:
+                    character_id = None
+            return await conn.fetchrow(
+                f"INSERT INTO poems (character_id, source, content, image_url) VALUES (?, ?, ?, ?) "
+                f"RETURNING {POEM_COLUMNS}",
+                character_id, source, content, image_url,
+            )
+
+    async def get_poem(self, poem_id: int) -> Optional[dict]:
+        async with self.db.acquire() as conn:
+            return await conn.fetchrow(f"SELECT {POEM_COLUMNS} FROM poems WHERE id = ?", poem_id)
+
+    async def update_poem_content(self, poem_id: int, content: str) -> dict:
+        async with self.db.transaction() as conn:
+            poem = await conn.fetchrow(
+                f"UPDATE poems SET content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? "
+                f"RETURNING {POEM_COLUMNS}",
+                content, poem_id,
+            )
+        if poem is None:
+            raise PoemNotFoundError(poem_id)
+        return poem
+
+    async def record_share(self, poem_id: int) -> dict:
+        async with self.db.transaction() as conn:
+            poem = await conn.fetchrow(
+                f"UPDATE poems SET share_count = share_count + 1 WHERE id = ? RETURNING {POEM_COLUMNS}",
+                poem_id,
+            )
+        if poem is None:
+            raise PoemNotFoundError(poem_id)
+        return poem
+
+    async def add_ratings(self, ratings: List[Tuple[int, int]]) -> List[Union[dict, Exception]]:
+        """評価をまとめて1トランザクションで書き込む（BatchScheduler から呼ばれる）
+
+        存在しないポエムへの評価はその要素だけ PoemNotFoundError になる。
+        """
+        poem_ids = sorted({poem_id for poem_id, _ in ratings})
+        async with self.db.transaction() as conn:
+            rows = await conn.fetch(
+                f"SELECT id FROM poems WHERE id IN ({_placeholders(len(poem_ids))})", *poem_ids
+            )
+            existing = {row["id"] for row in rows}
+            valid = [(poem_id, value) for poem_id, value in ratings if poem_id in existing]
+
+            if valid:
+                await conn.executemany("INSERT INTO ratings (poem_id, rating) VALUES (?, ?)", valid)
+                totals = {}
+                for poem_id, value in valid:
+                    count, score = totals.get(poem_id, (0, 0))
+                    totals[poem_id] = (count + 1, score + value)
+                await conn.executemany(
+                    "UPDATE poems SET rating_count = rating_count + ?, rating_score = rating_score + ? WHERE id = ?",
+                    [(count, score, poem_id) for poem_id, (count, score) in totals.items()],
+                )
+
+            updated = {}
+            if existing:
+                ids = sorted(existing)
+                for row in await conn.fetch(
+                    f"SELECT id, rating_count, rating_score FROM poems WHERE id IN ({_placeholders(len(ids))})", *ids
+                ):
+                    updated[row["id"]] = row
+
+        results: List[Union[dict, Exception]] = []
+        for poem_id, _ in ratings:
+            if poem_id in updated:
+                row = updated[poem_id]
+                results.append({
+                    "poem_id": poem_id,
+                    "rating_count": row["rating_count"],
+                    "rating_score": row["rating_score"],
+                })
+            else:
+                results.append(PoemNotFoundError(poem_id))
+        return results
+
+    async def list_poems(self, sort: str = "recent", limit: int = 20, cursor: Optional[str] = None) -> dict:
+        """キーセット方式でページングする（OFFSET を使わない）"""
+        if sort == "popular":
+            order_by = "rating_score DESC, id DESC"
+            cursor_condition = "(rating_score, id) < (?, ?)"
+            cursor_size = 2
+        elif sort == "recent":
+            order_by = "id DESC"
+            cursor_condition = "id < ?"
+            cursor_size = 1
+        else:
+            raise ValueError(f"Unsupported sort: {sort}")
+
+        args: List[Any] = []
+        where = ""
+        if cursor:
+            values = decode_cursor(cursor, cursor_size)
+            where = f"WHERE {cursor_condition}"
+            args = values
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {POEM_COLUMNS} FROM poems {where} ORDER BY {order_by} LIMIT ?",
+                *args, limit + 1,
+            )
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(
+                [last["rating_score"], last["id"]] if sort == "popular" else [last["id"]]
+            )
+        return {"poems": rows, "next_cursor": next_cursor}
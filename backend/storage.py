@@ -0,0 +1,227 @@
+import asyncio
+import io
+import logging
+import os
+import shutil
+from typing import Dict, Optional, Tuple
+
+from starlette.responses import FileResponse, RedirectResponse, Response
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(filename: str, depth: int = 2) -> str:
+    """ファイル名の先頭から2文字ずつ取ってサブディレクトリに振り分ける
+
+    `abcdef.png` -> `ab/cd/abcdef.png`。1つのディレクトリに
+    ファイルが溜まり続けないようにする。
+    """
+    parts = [filename[i * 2:i * 2 + 2] for i in range(depth)]
+    return "/".join(parts + [filename])
+
+
+class StorageBackend:
+    """アップロード画像の保存先の共通インターフェース"""
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    async def put_file(self, key: str, path: str, content_type: str) -> None:
+        """ローカルの一時ファイルを保存する（`path` は呼び出し後に消える）"""
+        raise NotImplementedError
+
+    def url_for(self, key: str) -> str:
+        return f"/uploads/{key}"
+
+    async def response_for(self, key: str) -> Response:
+        """`/uploads/{key}` へのリクエストに返すレスポンス"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class LocalStorage(StorageBackend):
+    """ローカルディスクに保存するドライバ（1コンテナ構成・開発用）"""
+
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> Optional[str]:
+        # 一時ファイル置き場などの隠しディレクトリは配信しない
+        if any(part.startswith(".") for part in key.split("/")):
+            return None
+        path = os.path.realpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    async def exists(self, key: str) -> bool:
+        path = self._path(key)
+        return path is not None and await asyncio.to_thread(os.path.isfile, path)
+
+    async def put_file(self, key: str, path: str, content_type: str) -> None:
+        dest = self._path(key)
+        if dest is None:
+            raise ValueError(f"Invalid storage key: {key}")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # 一時ファイルが別のファイルシステムにある場合はコピーになる
+        await asyncio.to_thread(shutil.move, path, dest)
+
+    async def response_for(self, key: str) -> Response:
+        path = self._path(key)
+        if path is None or not await asyncio.to_thread(os.path.isfile, path):
+            return Response(status_code=404)
+        return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+class S3Storage(StorageBackend):
+    """S3互換ストレージに保存するドライバ
+
+    大きなファイルは boto3 の TransferConfig によりマルチパートで送る。
+    画像の配信は署名付きURLへのリダイレクトで行い、APIプロセスは
+    画像のバイト列を中継しない。`public_url` を指定した場合（CDNなど）は
+    その URL を直接返す。
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        client=None,
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        prefix: str = "uploads/",
+        public_url: Optional[str] = None,
+        presign_expires: int = 3600,
+        multipart_threshold: int = 8 * 1024 * 1024,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.presign_expires = presign_expires
+        self.transfer_config = None
+
+        if client is None:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+            self.transfer_config = TransferConfig(
+                multipart_threshold=multipart_threshold,
+                multipart_chunksize=multipart_threshold,
+            )
+        self.client = client
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception as e:
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if error_code in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def put_file(self, key: str, path: str, content_type: str) -> None:
+        extra_args = {
+            "ContentType": content_type,
+            "CacheControl": "public, max-age=31536000, immutable",
+        }
+        try:
+            await asyncio.to_thread(
+                self.client.upload_file,
+                path,
+                self.bucket,
+                self._object_key(key),
+                ExtraArgs=extra_args,
+                Config=self.transfer_config,
+            )
+        finally:
+            os.unlink(path)
+
+    def url_for(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{self._object_key(key)}"
+        return super().url_for(key)
+
+    async def response_for(self, key: str) -> Response:
+        url = await asyncio.to_thread(
+            self.client.generate_presigned_url,
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=self.presign_expires,
+        )
+        return RedirectResponse(url, status_code=307)
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client:
+    """テスト用のプロセス内S3クライアント（S3Storage が使うメソッドのみ）"""
+
+    def __init__(self, endpoint: str = "http://fake-s3.local"):
+        self.endpoint = endpoint
+        self.objects: Dict[Tuple[str, str], Tuple[bytes, dict]] = {}
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("404")
+        body, extra = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(body), **extra}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, ExtraArgs=None, Config=None) -> None:
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = (f.read(), dict(ExtraArgs or {}))
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("NoSuchKey")
+        body, extra = self.objects[(Bucket, Key)]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), **extra}
+
+    def generate_presigned_url(self, ClientMethod: str, Params: dict, ExpiresIn: int = 3600) -> str:
+        return f"{self.endpoint}/{Params['Bucket']}/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+
+class MemoryStorage(S3Storage):
+    """FakeS3Client に保存する開発・テスト用ドライバ
+
+    署名付きURLの先が存在しないため、配信はリダイレクトせずに直接行う。
+    """
+
+    def __init__(self, bucket: str = "uploads"):
+        super().__init__(bucket, client=FakeS3Client())
+
+    async def response_for(self, key: str) -> Response:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except FakeS3Error:
+            return Response(status_code=404)
+        return Response(
+            obj["Body"].read(),
+            media_type=obj.get("ContentType"),
+            headers={"Cache-Control": obj.get("CacheControl", "no-cache")},
+        )
+
+
+def create_storage(kind: str, upload_dir: str) -> StorageBackend:
+    if kind == "local":
+        return LocalStorage(upload_dir)
+    if kind == "s3":
+        return S3Storage(
+            os.environ["AWS_S3_BUCKET"],
+            endpoint_url=os.getenv("AWS_S3_ENDPOINT_URL") or None,
+            region=os.getenv("AWS_REGION") or None,
+            public_url=os.getenv("AWS_S3_PUBLIC_URL") or None,
+        )
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,68 @@
+import json
+import time
+from collections import Counter, deque
+from typing import Optional
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Server-Sent Events の1イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class StreamTimer:
+    """1回のストリーミング生成の所要時間を記録する"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_byte: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.status = "completed"
+
+    def mark_first_byte(self) -> None:
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+
+    def finish(self, status: Optional[str] = None) -> None:
+        self.finished = time.perf_counter()
+        if status:
+            self.status = status
+
+    @property
+    def ttfb_ms(self) -> Optional[float]:
+        if self.first_byte is None:
+            return None
+        return (self.first_byte - self.started) * 1000
+
+    @property
+    def total_ms(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000
+
+
+def _percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class StreamMetrics:
+    """直近のストリーミング生成の TTFB / 合計レイテンシを集計する"""
+
+    def __init__(self, window: int = 1000):
+        self._ttfb = deque(maxlen=window)
+        self._total = deque(maxlen=window)
+        self.statuses = Counter()
+
+    def record(self, timer: StreamTimer) -> None:
+        self.statuses[timer.status] += 1
+        if timer.ttfb_ms is not None:
+            self._ttfb.append(timer.ttfb_ms)
+        self._total.append(timer.total_ms)
+
+    def stats(self) -> dict:
+        return {
+            "streams": dict(self.statuses),
+            "ttfb_ms": {"p50": _percentile(self._ttfb, 0.5), "p95": _percentile(self._ttfb, 0.95)},
+            "total_ms": {"p50": _percentile(self._total, 0.5), "p95": _percentile(self._total, 0.95)},
+        }
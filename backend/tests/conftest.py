@@ -0,0 +1,57 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# backend/ 直下のモジュールを import できるようにする（benchmarks と同じ）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def api(tmp_path_factory):
+    """HFスタブに向けて main のアプリを起動する
+
+    main は import 時に環境変数を読むので、セッションで1回だけ起動する。
+    切断を確かめられるよう TestClient ではなく実際のサーバーで動かす。
+    """
+    from benchmarks.stub_hf import StubStats, create_app, free_port, serve_in_thread
+
+    workdir = tmp_path_factory.mktemp("api")
+    stub_stats = StubStats()
+    stub_port = free_port()
+    # ストリーミングは4トークンを 0.2 秒おきに返す
+    stub = serve_in_thread(create_app(0.8, stub_stats), stub_port)
+
+    env = {
+        "HF_API_URL": f"http://127.0.0.1:{stub_port}/models/stub",
+        "HUGGINGFACE_API_KEY": "stub",
+        "INFERENCE_BACKENDS": "huggingface",
+        "DATABASE_URL": "",
+        "SQLITE_PATH": str(workdir / "poems.db"),
+        "JOB_QUEUE_PATH": str(workdir / "jobs.db"),
+        "UPLOAD_TMP_DIR": str(workdir / "incoming"),
+        "STORAGE_BACKEND": "local",
+        "LOG_FILE": "",
+        "LOG_LEVEL": "WARNING",
+    }
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    cwd = os.getcwd()
+    # uploads/ は作業ディレクトリに作られる
+    os.chdir(workdir)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+
+    port = free_port()
+    server = serve_in_thread(main.app, port)
+    yield SimpleNamespace(main=main, url=f"http://127.0.0.1:{port}", stub_stats=stub_stats)
+
+    server.should_exit = stub.should_exit = True
+    for key, value in saved.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
@@ -0,0 +1,63 @@
+import json
+
+import httpx
+
+
+def character(name):
+    return {"source": "character", "characterData": {"name": name, "work": "作品", "traits": "明るい"}}
+
+
+def read_events(response):
+    events = []
+    for block in response.text.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_sync_and_stream_save_only_the_generated_poem(api):
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        poem = client.post("/generate-poem", json=character("同期")).json()["poem"]
+        events = read_events(client.post("/generate-poem/stream", json=character("ストリーム")))
+        done = dict(events)["done"]
+
+        # どちらの経路でも、保存・返却されるのはプロンプトを除いた生成部分だけ
+        assert poem["content"] == "\n星の詩"
+        assert done["content"] == "星の詩を\n君に"
+        assert client.get(f"/poems/{poem['id']}").json()["content"] == poem["content"]
+        assert client.get(f"/poems/{done['id']}").json()["content"] == done["content"]
+        for row in client.get("/poems").json()["poems"]:
+            assert "あなたは詩人です" not in row["content"]
+
+
+def test_invalid_cursor_returns_400(api):
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        assert client.get("/poems", params={"cursor": "not-a-cursor"}).status_code == 400
+        recent_cursor = client.get("/poems", params={"limit": 1}).json()["next_cursor"]
+        assert client.get("/poems", params={"sort": "popular", "cursor": recent_cursor}).status_code == 400
+
+
+def test_missing_poems_return_404(api):
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        assert client.put("/customize-poem", json={"poem_id": 999999, "content": "詩"}).status_code == 404
+        assert client.post("/share-on-sns", json={"poem_id": 999999, "platform": "twitter"}).status_code == 404
+        assert client.post("/rate-poem", json={"poem_id": 999999, "rating": 1}).status_code == 404
+        assert client.get("/poems/999999").status_code == 404
+
+
+def test_ratings_go_through_the_rating_scheduler(api):
+    scheduler = api.main.rating_scheduler
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        poem = client.post("/generate-poem", json=character("評価")).json()["poem"]
+        items_before = scheduler.stats()["items"]
+
+        assert client.post("/rate-poem", json={"poem_id": poem["id"], "rating": "良い"}).json()["rating"] == {
+            "poem_id": poem["id"], "rating_count": 1, "rating_score": 1,
+        }
+        response = client.post("/rate-poem", json={"poem_id": poem["id"], "rating": "悪い"})
+        assert response.json()["rating"]["rating_score"] == 0
+        assert client.post("/rate-poem", json={"poem_id": poem["id"], "rating": 5}).status_code == 400
+
+        assert scheduler.stats()["items"] - items_before == 2
+        assert client.get(f"/poems/{poem['id']}").json()["rating_count"] == 2
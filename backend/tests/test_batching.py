@@ -0,0 +1,70 @@
+import asyncio
+
+from batching import BatchQueueFullError, BatchScheduler
+
+
+def test_saturated_upstream_fills_queue_and_rejects():
+    async def scenario():
+        release = asyncio.Event()
+        sent = []
+
+        async def send_batch(items):
+            sent.append(items)
+            await release.wait()
+            return items
+
+        scheduler = BatchScheduler(send_batch, max_batch_size=2, max_wait=0.001, max_queue=4, max_in_flight=1)
+        tasks = [asyncio.create_task(scheduler.submit(i)) for i in range(200)]
+        await asyncio.sleep(0.05)
+
+        # 上流が詰まっている間は、キューに入った分以外は断られる
+        rejected = [t for t in tasks if t.done() and isinstance(t.exception(), BatchQueueFullError)]
+        assert len(rejected) == 200 - 4
+        stats = scheduler.stats()
+        assert stats["in_flight"] == 1
+        assert stats["queued"] == 2
+
+        # 送信枠が空かない限りキューは減らないので、上限まで埋まって断られる
+        more = [asyncio.create_task(scheduler.submit(i)) for i in range(100, 110)]
+        await asyncio.sleep(0.05)
+        assert scheduler.stats()["queued"] == 4
+        assert scheduler.stats()["rejected"] == 196 + 8
+        assert len(sent) == 1
+
+        release.set()
+        accepted = [t for t in tasks + more if not (t.done() and t.exception() is not None)]
+        assert sorted(await asyncio.gather(*accepted)) == [0, 1, 2, 3, 100, 101]
+        await scheduler.close()
+
+    asyncio.run(scenario())
+
+
+def test_per_item_errors_only_reach_their_caller():
+    async def scenario():
+        async def send_batch(items):
+            return [ValueError(i) if i == 1 else i * 10 for i in items]
+
+        scheduler = BatchScheduler(send_batch, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(*(scheduler.submit(i) for i in range(3)), return_exceptions=True)
+        assert results[0] == 0 and results[2] == 20
+        assert isinstance(results[1], ValueError)
+        assert scheduler.stats()["batches"] == 1
+        await scheduler.close()
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_created_outside_a_loop_works_on_each_loop():
+    # main.py は import 時に作る。uvicorn.run やワーカーでは後から別のループで動く
+    async def send_batch(items):
+        return [i * 2 for i in items]
+
+    scheduler = BatchScheduler(send_batch, max_batch_size=4, max_wait=0.01, max_in_flight=1)
+
+    async def scenario():
+        results = await asyncio.wait_for(asyncio.gather(*(scheduler.submit(i) for i in range(6))), 5)
+        await scheduler.close()
+        return results
+
+    assert asyncio.run(scenario()) == [0, 2, 4, 6, 8, 10]
+    assert asyncio.run(scenario()) == [0, 2, 4, 6, 8, 10]
@@ -0,0 +1,273 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from batching import BatchScheduler
+from benchmarks.stub_hf import StubStats, create_app, free_port, serve_in_thread
+from inference import InferenceClient, InferenceError
+from inference_router import (
+    Backend,
+    CircuitBreaker,
+    HuggingFaceBackend,
+    InferenceRouter,
+    OpenAICompatibleBackend,
+)
+
+
+class ScriptedBackend(Backend):
+    """結果を順番に返すテスト用バックエンド（例外を入れるとそれを送出する）"""
+
+    def __init__(self, name, outcomes=(), delay=0.0):
+        self.name = name
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.calls = 0
+        self.cancelled = 0
+
+    async def generate(self, full_prompt, parameters):
+        self.calls += 1
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, Exception):
+            raise outcome
+        return f"{self.name}:{outcome}"
+
+
+def make_router(backends, **kwargs):
+    decisions = []
+    options = dict(max_attempts=1, backoff_base=0.0, hedge_ratio=0.0, on_decision=lambda d, b: decisions.append((d, b)))
+    options.update(kwargs)
+    router = InferenceRouter(backends, **options)
+    return router, decisions
+
+
+def test_breaker_open_half_open_closed_transitions():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    # half_open では試しの1件だけを通す
+    assert breaker.acquire()
+    assert not breaker.allow() and not breaker.acquire()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    assert breaker.acquire()
+    breaker.release()
+    assert breaker.acquire()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.failures == 0
+
+
+def test_half_open_router_sends_a_single_probe():
+    async def scenario():
+        backend = ScriptedBackend("flaky", [InferenceError(503, "down")], delay=0.05)
+        router, _ = make_router([backend], failure_threshold=1, reset_timeout=0.05)
+        with pytest.raises(InferenceError):
+            await router.generate("p", {})
+        assert router.states[0].breaker.state == "open"
+
+        await asyncio.sleep(0.06)
+        results = await asyncio.gather(*(router.generate("p", {}) for _ in range(5)), return_exceptions=True)
+
+        assert backend.calls == 2
+        assert results.count("flaky:ok") == 1
+        assert all(isinstance(r, InferenceError) and r.status_code == 503 for r in results if r != "flaky:ok")
+        assert router.states[0].breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_unexpected_exception_fails_over_and_frees_the_probe():
+    async def scenario():
+        first = ScriptedBackend("first", [ValueError("bad body"), ValueError("bad body"), "recovered"])
+        second = ScriptedBackend("second")
+        router, _ = make_router([first, second], max_attempts=2, failure_threshold=1, reset_timeout=0.05)
+
+        # 想定外の例外も再試行できるエラーとして次のバックエンドに回る
+        assert await router.generate("p", {}) == "second:ok"
+        assert router.states[0].breaker.state == "open"
+
+        # half_open の試しが想定外の例外で失敗しても、枠は残らず開き直す
+        await asyncio.sleep(0.06)
+        router.states = router.states[:1]
+        with pytest.raises(InferenceError) as excinfo:
+            await router.generate("p", {})
+        assert excinfo.value.status_code == 502
+        breaker = router.states[0].breaker
+        assert breaker.state == "open" and not breaker.probing
+
+        # 回復したら次の試しで閉じる
+        await asyncio.sleep(0.06)
+        assert await router.generate("p", {}) == "first:recovered"
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_non_json_response_is_an_inference_error():
+    async def scenario():
+        client = InferenceClient("http://upstream/models/stub")
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, text="<html>maintenance</html>", headers={"content-type": "text/html"})
+        ))
+        with pytest.raises(InferenceError) as excinfo:
+            await client.post({"inputs": "p"})
+        await client.close()
+        return excinfo.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 502
+
+
+@pytest.fixture(scope="module")
+def stub_servers():
+    hf_stats, openai_stats = StubStats(), StubStats()
+    hf_port, openai_port = free_port(), free_port()
+    hf = serve_in_thread(create_app(0.01, hf_stats, fail_rate=1.0), hf_port)
+    compat = serve_in_thread(create_app(0.01, openai_stats), openai_port)
+    yield {
+        "hf_url": f"http://127.0.0.1:{hf_port}/models/stub",
+        "openai_url": f"http://127.0.0.1:{openai_port}/v1",
+        "hf_stats": hf_stats,
+        "openai_stats": openai_stats,
+    }
+    hf.should_exit = compat.should_exit = True
+
+
+def test_retries_503_then_fails_over_to_second_backend(stub_servers):
+    async def scenario():
+        client = InferenceClient(stub_servers["hf_url"])
+        router, decisions = make_router(
+            [HuggingFaceBackend(client), OpenAICompatibleBackend(stub_servers["openai_url"], "stub")],
+            max_attempts=3,
+        )
+        text = await router.generate("prompt", {"max_length": 20})
+        await router.close()
+        await client.close()
+        return text, decisions, router
+
+    calls_before = stub_servers["hf_stats"].calls
+    text, decisions, router = asyncio.run(scenario())
+
+    assert text.startswith("prompt") and "星の詩" in text
+    assert stub_servers["hf_stats"].calls - calls_before == 1
+    assert decisions == [
+        ("primary", "huggingface"),
+        ("retry", "openai-compatible"),
+        ("primary", "openai-compatible"),
+    ]
+    hf_state = router.states[0]
+    assert hf_state.failures == 1 and hf_state.breaker.failures == 1
+
+
+def test_inference_client_created_outside_a_loop_works_on_each_loop(stub_servers):
+    # main.py は import 時に作るので、後から別のループで並行に使われる
+    client = InferenceClient(stub_servers["openai_url"].replace("/v1", "/models/stub"), max_concurrency=1)
+
+    async def scenario():
+        results = await asyncio.wait_for(
+            asyncio.gather(*(client.post({"inputs": f"p{i}"}) for i in range(3))), 5
+        )
+        await client.close()
+        return results
+
+    assert len(asyncio.run(scenario())) == 3
+    assert len(asyncio.run(scenario())) == 3
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        first = ScriptedBackend("first", [InferenceError(400, "bad request")])
+        second = ScriptedBackend("second")
+        router, _ = make_router([first, second], max_attempts=3)
+        with pytest.raises(InferenceError) as excinfo:
+            await router.generate("p", {})
+        assert excinfo.value.status_code == 400
+        assert second.calls == 0
+        assert router.states[0].breaker.failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_hedge_fires_after_delay_and_loser_is_cancelled():
+    async def scenario():
+        slow = ScriptedBackend("slow", delay=1.0)
+        fast = ScriptedBackend("fast", delay=0.01)
+        router, decisions = make_router([slow, fast], hedge_delay=0.05, hedge_ratio=1.0)
+
+        started = time.perf_counter()
+        text = await router.generate("p", {})
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0)
+
+        assert text == "fast:ok"
+        assert 0.05 <= elapsed < 0.5
+        assert decisions == [("primary", "slow"), ("hedge", "fast")]
+        assert slow.cancelled == 1
+        assert router.hedges == 1
+        # キャンセルされた側は失敗として数えない
+        assert router.states[0].breaker.failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_hedge_ratio_caps_duplicate_requests():
+    async def scenario():
+        backend = ScriptedBackend("slow", delay=0.02)
+        router, _ = make_router([backend], hedge_delay=0.001, hedge_ratio=0.1)
+        await asyncio.gather(*(router.generate("p", {}) for _ in range(50)))
+        for _ in range(50):
+            await router.generate("p", {})
+
+        assert 0 < router.hedges <= 0.1 * 100 + 1
+        assert backend.calls == 100 + router.hedges
+
+    asyncio.run(scenario())
+
+
+def test_full_batch_queue_fails_over_through_router():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def send_batch(prompts):
+            await release.wait()
+            return [f"{p}:batched" for p in prompts]
+
+        scheduler = BatchScheduler(send_batch, max_batch_size=1, max_wait=0.0, max_queue=1, max_in_flight=1)
+        batched = HuggingFaceBackend(client=None, batch=scheduler)
+        fallback = ScriptedBackend("fallback")
+        router, _ = make_router([batched, fallback], max_attempts=2)
+
+        first = asyncio.create_task(router.generate("a", {}))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(router.generate("b", {}))
+        await asyncio.sleep(0.01)
+        # 送信枠とキューが埋まったので、3件目は HF では断られて次のバックエンドへ
+        assert await router.generate("c", {}) == "fallback:ok"
+        # 手元の混雑は HF の障害として数えない
+        assert router.states[0].failures == 0
+        assert router.states[0].breaker.failures == 0
+        assert router.states[0].breaker.state == "closed"
+
+        release.set()
+        assert await first == "a:batched"
+        assert await second == "b:batched"
+        await scheduler.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,289 @@
+import asyncio
+import datetime
+import socket
+import sqlite3
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import jobs
+from jobs import CallbackURLError, JobQueue, JobQueueFullError, check_callback_url, public_job
+import worker
+from worker import Worker, deliver_callback
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=0.2, max_attempts=2)
+    yield q
+    q.close()
+
+
+def make_worker(queue, create_poem):
+    api = SimpleNamespace(
+        job_queue=queue,
+        create_poem=create_poem,
+        PoemRequest=lambda **payload: payload,
+        public_job=public_job,
+    )
+    return Worker(api, concurrency=1)
+
+
+def run_job(queue, create_poem):
+    async def scenario():
+        worker = make_worker(queue, create_poem)
+        job = queue.claim("w1")
+        await worker.process(job)
+        await worker.callbacks.aclose()
+        return queue.get(job["id"])
+
+    return asyncio.run(scenario())
+
+
+def test_result_with_datetimes_is_stored(queue):
+    queue.enqueue({"source": "character"}, "alice")
+
+    async def create_poem(request):
+        # asyncpg の行と同じく created_at が datetime
+        return {"id": 1, "content": "詩", "created_at": datetime.datetime(2024, 1, 2, 3, 4, 5)}
+
+    job = run_job(queue, create_poem)
+    assert job["status"] == "succeeded"
+    assert job["result"]["created_at"] == "2024-01-02T03:04:05"
+
+
+def test_storage_error_fails_only_that_job(queue, monkeypatch):
+    queue.enqueue({"source": "character"}, "alice")
+
+    def broken_complete(job_id, result):
+        raise ValueError("cannot store result")
+
+    monkeypatch.setattr(queue, "complete", broken_complete)
+
+    async def create_poem(request):
+        return {"id": 1}
+
+    job = run_job(queue, create_poem)
+    assert job["status"] == "failed"
+    assert "cannot store result" in job["error"]
+
+
+def test_slot_survives_queue_errors(queue, monkeypatch):
+    calls = 0
+
+    def flaky_claim(worker_id):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("database is locked")
+        worker.stopping.set()
+        return None
+
+    async def scenario():
+        nonlocal worker
+        worker = make_worker(queue, None)
+        monkeypatch.setattr(queue, "claim", flaky_claim)
+        await asyncio.wait_for(worker.slot(), 5)
+        await worker.callbacks.aclose()
+
+    worker = None
+    asyncio.run(scenario())
+    assert calls == 2
+
+
+def test_run_worker_builds_worker_on_the_running_loop(monkeypatch):
+    # Python 3.9 の asyncio.Event は作成時のループに紐づくので、ループの外で作ると動かない
+    loops = []
+
+    async def fake_run(self):
+        loops.append((self.loop, asyncio.get_running_loop()))
+
+    def fake_init(self, api, concurrency):
+        self.loop = asyncio.get_running_loop()
+
+    monkeypatch.setitem(sys.modules, "main", SimpleNamespace())
+    monkeypatch.setattr(Worker, "__init__", fake_init)
+    monkeypatch.setattr(Worker, "run", fake_run)
+    worker.run_worker(1)
+
+    [(created_on, ran_on)] = loops
+    assert created_on is ran_on
+
+
+def test_retryable_errors_requeue_with_backoff(queue):
+    queue.enqueue({"source": "character"}, "alice")
+
+    async def create_poem(request):
+        raise HTTPException(status_code=503, detail="busy")
+
+    job = run_job(queue, create_poem)
+    assert job["status"] == "queued"
+    assert job["available_at"] > time.time()
+
+
+def test_expired_lease_is_requeued_then_failed(queue):
+    created = queue.enqueue({}, "alice")
+    first = queue.claim("w1")
+    time.sleep(0.25)
+    second = queue.claim("w2")
+    assert second["id"] == first["id"] == created["id"]
+    assert second["attempts"] == 2
+
+    time.sleep(0.25)
+    assert queue.claim("w3") is None
+    assert queue.get(created["id"])["status"] == "failed"
+
+
+def test_pending_jobs_per_client_are_capped(tmp_path):
+    q = JobQueue(str(tmp_path / "capped.db"), max_pending_per_client=2)
+    q.enqueue({}, "alice")
+    q.enqueue({}, "alice")
+    with pytest.raises(JobQueueFullError):
+        q.enqueue({}, "alice")
+    q.enqueue({}, "bob")
+    q.close()
+
+
+def resolve_to(monkeypatch, address):
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    monkeypatch.setattr(
+        jobs.socket, "getaddrinfo",
+        lambda host, port, **kwargs: [(family, socket.SOCK_STREAM, 6, "", (address, port))],
+    )
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1:8000/hook",
+    "http://localhost/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.1/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "http://0.0.0.0/hook",
+    "ftp://example.com/hook",
+])
+def test_callback_url_rejects_internal_addresses(url):
+    with pytest.raises(CallbackURLError):
+        check_callback_url(url)
+
+
+def test_callback_url_checks_every_resolved_address(monkeypatch):
+    resolve_to(monkeypatch, "93.184.216.34")
+    check_callback_url("https://hooks.example.com/poem")
+
+    resolve_to(monkeypatch, "172.16.0.10")
+    with pytest.raises(CallbackURLError):
+        check_callback_url("https://hooks.example.com/poem")
+
+
+def test_callback_allowlist(monkeypatch):
+    resolve_to(monkeypatch, "93.184.216.34")
+    allowed = {"hooks.internal"}
+    check_callback_url("http://hooks.internal:8080/poem", allowed)
+    with pytest.raises(CallbackURLError):
+        check_callback_url("https://hooks.example.com/poem", allowed)
+
+
+def test_callback_is_not_sent_when_host_turns_internal(monkeypatch):
+    # 受付後に DNS がループバックを返すようになった場合
+    resolve_to(monkeypatch, "127.0.0.1")
+    sent = []
+
+    class RecordingClient:
+        async def post(self, url, **kwargs):
+            sent.append(url)
+
+    asyncio.run(deliver_callback(RecordingClient(), "https://hooks.example.com/poem", {"job_id": "j1"}))
+    assert sent == []
+
+
+def claim_all(queue):
+    order = []
+    while (job := queue.claim("w1")) is not None:
+        queue.complete(job["id"], {})
+        order.append((job["client_id"], job["priority"]))
+    return order
+
+
+def test_high_priority_does_not_starve_other_clients(queue):
+    for _ in range(5):
+        queue.enqueue({}, "heavy", priority=9)
+    queue.enqueue({}, "light", priority=0)
+
+    order = claim_all(queue)
+    assert ("light", 0) in order[:2]
+
+
+def test_priority_orders_jobs_within_a_client(queue):
+    queue.enqueue({"n": 1}, "alice", priority=0)
+    queue.enqueue({"n": 2}, "alice", priority=5)
+    queue.enqueue({"n": 3}, "alice", priority=0)
+
+    assert [priority for _, priority in claim_all(queue)] == [5, 0, 0]
+
+
+def test_stats_do_not_wait_for_writers(queue):
+    queue.enqueue({}, "alice")
+    # 別プロセスが書き込みトランザクション中で、このプロセスの enqueue がそれを待っている状態
+    other = sqlite3.connect(queue.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with queue._lock:
+            started = time.perf_counter()
+            counts = queue.stats()
+            elapsed = time.perf_counter() - started
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    assert counts["queued"] == 1
+    assert elapsed < 0.05
+
+
+def test_callback_connects_to_the_checked_address(monkeypatch):
+    # 確認のあとで DNS がループバックを返すようになっても、確認したアドレスに送る
+    answers = ["93.184.216.34"]
+
+    def rebinding_getaddrinfo(host, port, **kwargs):
+        address = answers.pop(0) if answers else "127.0.0.1"
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    monkeypatch.setattr(jobs.socket, "getaddrinfo", rebinding_getaddrinfo)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(204)
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await deliver_callback(client, "https://hooks.example.com:8443/poem?x=1", {"job_id": "j1"})
+
+    asyncio.run(scenario())
+    [request] = requests
+    assert str(request.url) == "https://93.184.216.34:8443/poem?x=1"
+    assert request.headers["host"] == "hooks.example.com:8443"
+    assert request.extensions["sni_hostname"] == "hooks.example.com"
+
+
+def test_allowlisted_callback_keeps_the_hostname(monkeypatch):
+    monkeypatch.setattr(worker, "CALLBACK_ALLOWED_HOSTS", {"hooks.internal"})
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(204)
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await deliver_callback(client, "http://hooks.internal/poem", {"job_id": "j1"})
+
+    asyncio.run(scenario())
+    [request] = requests
+    assert request.url.host == "hooks.internal"
+    assert "sni_hostname" not in request.extensions
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from poem_cache import PoemCache, SQLiteCacheBackend
+
+
+def test_leader_cancellation_does_not_cancel_followers():
+    async def scenario():
+        cache = PoemCache(variants=1)
+        release = asyncio.Event()
+        calls = 0
+
+        async def generate():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "poem"
+
+        leader = asyncio.create_task(cache.get_or_generate("k", generate))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_generate("k", generate))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await follower == "poem"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert calls == 1
+        assert cache.get("k") == "poem"
+        assert cache.stats()["coalesced"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_generation_error_reaches_every_waiter_and_is_not_cached():
+    async def scenario():
+        cache = PoemCache(variants=1)
+
+        async def generate():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(
+            cache.get_or_generate("k", generate),
+            cache.get_or_generate("k", generate),
+            return_exceptions=True,
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert cache.get("k") is None
+
+    asyncio.run(scenario())
+
+
+def test_evicted_keys_are_removed_from_backend(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "cache.db")
+        cache = PoemCache(max_entries=2, variants=1, backend=SQLiteCacheBackend(path))
+        for key in ("a", "b", "c"):
+            await cache.put(key, f"poem {key}")
+        cache.close()
+
+        backend = SQLiteCacheBackend(path)
+        assert sorted(key for key, _, _ in backend.load()) == ["b", "c"]
+        backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_empty_results_are_not_cached():
+    async def scenario():
+        cache = PoemCache(variants=1)
+        await cache.put("k", "  \n")
+        assert cache.get("k") is None
+        assert cache.stats()["entries"] == 0
+
+    asyncio.run(scenario())
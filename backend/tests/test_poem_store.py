@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from batching import BatchScheduler
+from database import SQLiteDatabase
+from poem_store import InvalidCursorError, PoemNotFoundError, PoemStore, encode_cursor
+
+
+def run_with_store(tmp_path, scenario):
+    async def wrapper():
+        database = SQLiteDatabase(str(tmp_path / "poems.db"))
+        await database.connect()
+        try:
+            return await scenario(PoemStore(database))
+        finally:
+            await database.close()
+
+    return asyncio.run(wrapper())
+
+
+async def create_poems(store, count):
+    return [(await store.create_poem(f"詩{i}", "character"))["id"] for i in range(count)]
+
+
+async def collect_pages(store, sort, limit):
+    ids, cursor = [], None
+    while True:
+        page = await store.list_poems(sort=sort, limit=limit, cursor=cursor)
+        ids.extend(poem["id"] for poem in page["poems"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids
+
+
+def test_popular_pages_through_tied_scores_without_gaps(tmp_path):
+    async def scenario(store):
+        ids = await create_poems(store, 7)
+        scores = {ids[0]: 1, ids[1]: 1, ids[2]: 1, ids[3]: 0, ids[4]: 2, ids[5]: 1, ids[6]: -1}
+        await store.add_ratings([(poem_id, 1 if score > 0 else -1) for poem_id, score in scores.items() if score])
+        await store.add_ratings([(ids[4], 1)])
+        return scores, await collect_pages(store, "popular", 2)
+
+    scores, ids = run_with_store(tmp_path, scenario)
+    # 同点は id の降順で、ページの境目で重複・欠落しない
+    assert ids == sorted(scores, key=lambda poem_id: (-scores[poem_id], -poem_id))
+
+
+def test_recent_pages_newest_first(tmp_path):
+    async def scenario(store):
+        ids = await create_poems(store, 5)
+        return ids, await collect_pages(store, "recent", 2)
+
+    created, ids = run_with_store(tmp_path, scenario)
+    assert ids == created[::-1]
+
+
+@pytest.mark.parametrize("sort, cursor", [
+    ("recent", "not-a-cursor"),
+    ("recent", encode_cursor(["1"])),
+    ("popular", encode_cursor([3])),
+    ("recent", encode_cursor([1, 2])),
+])
+def test_invalid_cursor_is_rejected(tmp_path, sort, cursor):
+    async def scenario(store):
+        with pytest.raises(InvalidCursorError):
+            await store.list_poems(sort=sort, cursor=cursor)
+
+    run_with_store(tmp_path, scenario)
+
+
+def test_batched_ratings_fail_only_for_missing_poems(tmp_path):
+    async def scenario(store):
+        [poem_id] = await create_poems(store, 1)
+        scheduler = BatchScheduler(store.add_ratings, max_batch_size=8, max_wait=0.05)
+        results = await asyncio.gather(
+            scheduler.submit((poem_id, 1)),
+            scheduler.submit((999, 1)),
+            scheduler.submit((poem_id, -1)),
+            scheduler.submit((poem_id, 1)),
+            return_exceptions=True,
+        )
+        await scheduler.close()
+        return poem_id, results, scheduler.stats(), await store.get_poem(poem_id)
+
+    poem_id, results, stats, poem = run_with_store(tmp_path, scenario)
+    assert stats["batches"] == 1
+    assert isinstance(results[1], PoemNotFoundError) and results[1].poem_id == 999
+    assert [r["poem_id"] for r in (results[0], results[2], results[3])] == [poem_id] * 3
+    assert results[3] == {"poem_id": poem_id, "rating_count": 3, "rating_score": 1}
+    assert poem["rating_count"] == 3 and poem["rating_score"] == 1
+
+
+def test_updates_to_missing_poems_raise_not_found(tmp_path):
+    async def scenario(store):
+        [poem_id] = await create_poems(store, 1)
+        with pytest.raises(PoemNotFoundError):
+            await store.update_poem_content(999, "書き換え")
+        with pytest.raises(PoemNotFoundError):
+            await store.record_share(999)
+
+        updated = await store.update_poem_content(poem_id, "書き換え")
+        shared = await store.record_share(poem_id)
+        assert updated["content"] == "書き換え"
+        assert shared["share_count"] == 1
+
+    run_with_store(tmp_path, scenario)
+
+
+def test_missing_character_is_not_linked(tmp_path):
+    async def scenario(store):
+        character = await store.create_character("名前", "作品", "明るい", None)
+        linked = await store.create_poem("詩", "character", character_id=character["id"])
+        unlinked = await store.create_poem("詩", "character", character_id=999)
+        assert linked["character_id"] == character["id"]
+        assert unlinked["character_id"] is None
+
+    run_with_store(tmp_path, scenario)
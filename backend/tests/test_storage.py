@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from storage import FakeS3Client, FakeS3Error, LocalStorage, MemoryStorage, S3Storage, create_storage, shard_key
+
+
+def write_temp(tmp_path, name="upload.part", data=b"image-bytes"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_shard_key_splits_name_into_two_levels():
+    assert shard_key("abcdef.png") == "ab/cd/abcdef.png"
+    assert shard_key("abcdef_thumb.webp") == "ab/cd/abcdef_thumb.webp"
+
+
+@pytest.mark.parametrize("key", [
+    "../outside.png",
+    "ab/../../outside.png",
+    ".incoming/abcd.part",
+    "ab/.hidden/file.png",
+    "/etc/passwd",
+])
+def test_local_storage_rejects_hidden_and_escaping_paths(tmp_path, key):
+    storage = LocalStorage(str(tmp_path / "uploads"))
+    assert storage._path(key) is None
+
+    async def scenario():
+        assert not await storage.exists(key)
+        assert (await storage.response_for(key)).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_local_storage_put_exists_and_serve(tmp_path):
+    storage = LocalStorage(str(tmp_path / "uploads"))
+    key = shard_key("abcdef.png")
+
+    async def scenario():
+        assert not await storage.exists(key)
+        await storage.put_file(key, write_temp(tmp_path), "image/png")
+        assert await storage.exists(key)
+        response = await storage.response_for(key)
+        assert response.status_code == 200
+        assert "immutable" in response.headers["cache-control"]
+
+    asyncio.run(scenario())
+    assert (tmp_path / "uploads" / "ab" / "cd" / "abcdef.png").read_bytes() == b"image-bytes"
+
+
+def test_s3_storage_through_fake_client(tmp_path):
+    client = FakeS3Client(endpoint="http://s3.test")
+    storage = S3Storage("bucket", client=client, prefix="uploads/", presign_expires=60)
+    key = shard_key("abcdef.png")
+    temp = write_temp(tmp_path)
+
+    async def scenario():
+        assert not await storage.exists(key)
+        await storage.put_file(key, temp, "image/png")
+        assert await storage.exists(key)
+        return await storage.response_for(key)
+
+    response = asyncio.run(scenario())
+
+    body, extra = client.objects[("bucket", "uploads/ab/cd/abcdef.png")]
+    assert body == b"image-bytes"
+    assert extra["ContentType"] == "image/png"
+    # アップロード後は一時ファイルを消す
+    assert not (tmp_path / "upload.part").exists()
+    assert response.status_code == 307
+    assert response.headers["location"] == "http://s3.test/bucket/uploads/ab/cd/abcdef.png?X-Amz-Expires=60"
+    assert storage.url_for(key) == "/uploads/ab/cd/abcdef.png"
+
+
+def test_s3_storage_public_url_skips_api():
+    storage = S3Storage("bucket", client=FakeS3Client(), public_url="https://cdn.test/")
+    assert storage.url_for("ab/cd/abcdef.png") == "https://cdn.test/uploads/ab/cd/abcdef.png"
+
+
+def test_s3_storage_propagates_non_404_errors():
+    class BrokenClient(FakeS3Client):
+        def head_object(self, Bucket, Key):
+            raise FakeS3Error("AccessDenied")
+
+    storage = S3Storage("bucket", client=BrokenClient())
+    with pytest.raises(FakeS3Error):
+        asyncio.run(storage.exists("ab/cd/abcdef.png"))
+
+
+def test_memory_storage_serves_bodies_itself(tmp_path):
+    storage = create_storage("memory", str(tmp_path))
+    assert isinstance(storage, MemoryStorage)
+    key = shard_key("abcdef.png")
+
+    async def scenario():
+        missing = await storage.response_for(key)
+        await storage.put_file(key, write_temp(tmp_path), "image/png")
+        return missing, await storage.response_for(key)
+
+    missing, found = asyncio.run(scenario())
+    assert missing.status_code == 404
+    assert found.status_code == 200
+    assert found.body == b"image-bytes"
+    assert found.headers["content-type"] == "image/png"
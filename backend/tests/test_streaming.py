@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from inference import InferenceError
+
+
+def character(name):
+    return {"source": "character", "characterData": {"name": name, "work": "作品", "traits": "明るい"}}
+
+
+def read_events(response):
+    events = []
+    for block in response.text.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.fixture
+def hf_breaker(api):
+    [state] = [s for s in api.main.inference_router.states if s.backend.name == "huggingface"]
+    yield state.breaker
+    state.breaker.record_success()
+
+
+def test_disconnect_after_first_token_stops_upstream(api, hf_breaker):
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        completed = api.stub_stats.streams_completed
+        cancelled = client.get("/stream-stats").json()["streams"].get("cancelled", 0)
+
+        with client.stream("POST", "/generate-poem/stream", json=character("切断")) as response:
+            for line in response.iter_lines():
+                if line == "event: token":
+                    break
+        # スタブは残りの3トークンを 0.6 秒かけて返すはずだった
+        time.sleep(1.0)
+
+        assert api.stub_stats.streams_completed == completed
+        assert client.get("/stream-stats").json()["streams"]["cancelled"] == cancelled + 1
+        # 切断はバックエンドの失敗として数えない
+        assert hf_breaker.failures == 0 and not hf_breaker.probing
+
+
+def test_cache_hit_replays_the_poem_as_one_token(api):
+    main = api.main
+    body = character("キャッシュ")
+    prompt = main.build_prompt(main.PoemRequest(**body))
+    key = main.make_cache_key(prompt, main.GENERATION_PARAMETERS)
+    variants = [f"{main.build_full_prompt(prompt)}\n詩{i}" for i in range(main.poem_cache.variants)]
+    for text in variants:
+        asyncio.run(main.poem_cache.put(key, text))
+
+    calls = api.stub_stats.calls
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        events = read_events(client.post("/generate-poem/stream", json=body))
+
+    assert [name for name, _ in events] == ["token", "done"]
+    (_, token), (_, done) = events
+    assert token["text"] in [f"\n詩{i}" for i in range(len(variants))]
+    assert done["content"] == token["text"]
+    assert set(done) == {"id", "content", "ttfb_ms", "total_ms"}
+    assert api.stub_stats.calls == calls
+
+
+def test_upstream_error_is_sent_as_error_event_and_counted(api, hf_breaker, monkeypatch):
+    async def failing_stream(payload, timeout=None):
+        raise InferenceError(503, "Failed to generate text")
+        yield
+
+    monkeypatch.setattr(api.main.inference_client, "stream", failing_stream)
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        events = read_events(client.post("/generate-poem/stream", json=character("エラー")))
+
+    assert events == [("error", {"detail": "Failed to generate text"})]
+    assert hf_breaker.failures == 1 and not hf_breaker.probing
+
+
+def test_empty_stream_is_sent_as_error_event(api, hf_breaker, monkeypatch):
+    async def empty_stream(payload, timeout=None):
+        yield {"token": {"text": "</s>", "special": True}}
+
+    monkeypatch.setattr(api.main.inference_client, "stream", empty_stream)
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        events = read_events(client.post("/generate-poem/stream", json=character("空")))
+
+    assert events == [("error", {"detail": "ポエムの生成に失敗しました"})]
+
+
+def test_half_open_breaker_lets_only_the_probe_stream(api, hf_breaker):
+    hf_breaker.record_failure()
+    hf_breaker.opened_at = time.monotonic() - hf_breaker.reset_timeout
+    assert hf_breaker.state == "half_open"
+
+    # 他のリクエストが試しの枠を使っている間は HF に流さない
+    probe = api.main.inference_router.claim("huggingface")
+    assert probe is not None
+    calls = api.stub_stats.calls
+    with httpx.Client(base_url=api.url, timeout=30) as client:
+        events = read_events(client.post("/generate-poem/stream", json=character("試し")))
+        assert events == [("error", {"detail": "No healthy inference backend"})]
+        assert api.stub_stats.calls == calls
+
+        # 試しが終われば次のストリームが試しとして流れ、成功すれば閉じる
+        api.main.inference_router.report(probe, 0.0, InferenceError(400, "bad request"))
+        events = read_events(client.post("/generate-poem/stream", json=character("試し")))
+        assert [name for name, _ in events][-1] == "done"
+        assert hf_breaker.state == "closed"
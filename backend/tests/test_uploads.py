@@ -0,0 +1,102 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+from starlette.requests import Request
+
+from storage import LocalStorage
+from uploads import MAX_IMAGE_PIXELS, UploadError, UploadStore, make_variants
+
+
+def test_variants_are_downscaled_from_largest_to_smallest(tmp_path):
+    source = tmp_path / "photo.jpg"
+    Image.new("RGB", (4000, 3000), "red").save(source)
+
+    paths = make_variants(str(source), str(tmp_path / "photo"))
+
+    sizes = {path.rsplit("_", 1)[1]: Image.open(path).size for path in paths}
+    assert sizes == {"medium.webp": (1024, 768), "thumb.webp": (256, 192)}
+
+
+def test_palette_image_with_transparency_keeps_alpha(tmp_path):
+    source = tmp_path / "icon.png"
+    image = Image.new("P", (300, 300))
+    image.info["transparency"] = 0
+    image.save(source)
+
+    paths = make_variants(str(source), str(tmp_path / "icon"))
+
+    assert all(Image.open(path).mode == "RGBA" for path in paths)
+
+
+def test_pixel_bomb_is_rejected_before_decoding(tmp_path):
+    source = tmp_path / "bomb.png"
+    side = int(MAX_IMAGE_PIXELS ** 0.5) + 100
+    Image.new("L", (side, side)).save(source)
+    # 圧縮後は小さいので、ファイルサイズの上限では防げない
+    assert source.stat().st_size < 1024 * 1024
+
+    with pytest.raises(UploadError) as excinfo:
+        make_variants(str(source), str(tmp_path / "bomb"))
+    assert excinfo.value.status_code == 400
+    assert list(tmp_path.glob("bomb_*")) == []
+
+
+def multipart_request(payload: bytes, boundary: str = "testboundary") -> Request:
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="photo.png"\r\n'
+        "Content-Type: image/png\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+    chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+
+    async def receive():
+        if chunks:
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+        return {"type": "http.disconnect"}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/upload-photo",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    return Request(scope, receive)
+
+
+def png_bytes(size=(640, 480), color="blue") -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_concurrent_duplicate_uploads_all_succeed_and_clean_up(tmp_path):
+    async def scenario():
+        tmp_dir = tmp_path / ".incoming"
+        store = UploadStore(LocalStorage(str(tmp_path)), str(tmp_dir), workers=4)
+        payload = png_bytes()
+        results = await asyncio.gather(*(store.save(multipart_request(payload)) for _ in range(4)))
+        store.close()
+
+        assert len({r["filename"] for r in results}) == 1
+        assert all(set(r["variants"]) == {"thumb", "medium"} for r in results)
+        assert list(tmp_dir.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_rejected_upload_leaves_no_temp_files(tmp_path):
+    async def scenario():
+        tmp_dir = tmp_path / ".incoming"
+        store = UploadStore(LocalStorage(str(tmp_path)), str(tmp_dir))
+        with pytest.raises(UploadError):
+            await store.save(multipart_request(b"not an image at all"))
+        store.close()
+        assert list(tmp_dir.iterdir()) == []
+
+    asyncio.run(scenario())
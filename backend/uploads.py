@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+from PIL import Image
+from starlette.requests import Request
+
+from storage import StorageBackend, shard_key
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB制限
+
+# 先頭バイトで判定する（クライアントの Content-Type は信用しない）
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"GIF87a", "image/gif", ".gif"),
+    (b"GIF89a", "image/gif", ".gif"),
+]
+SNIFF_SIZE = max(len(signature) for signature, _, _ in IMAGE_SIGNATURES)
+
+# 生成するバリエーション（接尾辞, 長辺の最大ピクセル数）
+IMAGE_VARIANTS = [
+    ("thumb", 256),
+    ("medium", 1024),
+]
+
+# デコードを許す画素数の上限（RGBA で約100MB）。5MBのPNGでも数億画素に展開できるため
+MAX_IMAGE_PIXELS = 24_000_000
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_image_type(head: bytes) -> Optional[Tuple[str, str]]:
+    for signature, content_type, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type, extension
+    return None
+
+
+class IncomingFile:
+    """受信を終えた一時ファイルとそのハッシュ"""
+
+    def __init__(self, path: str, digest: str, size: int, content_type: str, extension: str):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.content_type = content_type
+        self.extension = extension
+
+    @property
+    def filename(self) -> str:
+        return f"{self.digest}{self.extension}"
+
+
+async def receive_upload(
+    request: Request,
+    tmp_dir: str,
+    field_name: str = "file",
+    max_size: int = MAX_UPLOAD_SIZE,
+) -> IncomingFile:
+    """multipart のリクエストボディを逐次読みながら一時ファイルに書き込む
+
+    ボディ全体をメモリに載せず、受信しながら SHA-256 を計算し、
+    サイズ上限を超えた時点で読み込みを打ち切る。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError(400, "multipart/form-data で送信してください")
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size + 64 * 1024:
+        raise UploadError(413, "ファイルサイズが大きすぎます")
+
+    # パーサーのコールバックは同期なので、受け取ったデータを一旦ここに溜めて
+    # チャンクごとに非同期で処理する
+    state = {"header_field": b"", "header_value": b"", "disposition": b"", "in_file": False, "found": False}
+    pending: List[bytes] = []
+
+    def on_part_begin():
+        state["disposition"] = b""
+        state["in_file"] = False
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        if state["header_field"].lower() == b"content-disposition":
+            state["disposition"] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["disposition"])
+        if options.get(b"name") == field_name.encode() and not state["found"]:
+            state["in_file"] = True
+            state["found"] = True
+
+    def on_part_data(data, start, end):
+        if state["in_file"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        state["in_file"] = False
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    try:
+        with os.fdopen(fd, "wb") as out:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if not pending:
+                    continue
+                data = b"".join(pending)
+                pending.clear()
+
+                size += len(data)
+                if size > max_size:
+                    raise UploadError(413, "ファイルサイズが大きすぎます")
+                if len(head) < SNIFF_SIZE:
+                    head += data[:SNIFF_SIZE - len(head)]
+                    if len(head) >= SNIFF_SIZE and sniff_image_type(head) is None:
+                        raise UploadError(400, "許可されていないファイル形式です")
+                digest.update(data)
+                await asyncio.to_thread(out.write, data)
+            parser.finalize()
+
+        if not state["found"] or size == 0:
+            raise UploadError(400, "ファイルが見つかりません")
+        detected = sniff_image_type(head)
+        if detected is None:
+            raise UploadError(400, "許可されていないファイル形式です")
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return IncomingFile(tmp_path, digest.hexdigest(), size, *detected)
+
+
+def make_variants(source_path: str, dest_base: str) -> List[str]:
+    """縮小したWebP版を作る（ワーカースレッドで実行する）
+
+    画素数はヘッダーだけで確認し、大きすぎる画像はデコードしない。
+    JPEG はデコード時点で縮小（draft）し、大きいバリエーションから順に
+    同じ画像をその場で縮小していくので、原寸のコピーは作らない。
+    """
+    created = []
+    try:
+        source = Image.open(source_path)
+    except Image.DecompressionBombError:
+        raise UploadError(400, "画像の解像度が大きすぎます")
+    with source as image:
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise UploadError(400, "画像の解像度が大きすぎます")
+        image.seek(0)
+        largest = max(max_side for _, max_side in IMAGE_VARIANTS)
+        image.draft("RGB", (largest, largest))
+        if image.mode not in ("RGB", "RGBA"):
+            has_alpha = image.mode in ("LA", "PA") or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        for suffix, max_side in sorted(IMAGE_VARIANTS, key=lambda v: v[1], reverse=True):
+            image.thumbnail((max_side, max_side))
+            path = f"{dest_base}_{suffix}.webp"
+            image.save(path, "WEBP", quality=80, method=4)
+            created.append(path)
+    return created
+
+
+class UploadStore:
+    """コンテンツハッシュをキーにして画像を1度だけ保存する"""
+
+    def __init__(self, storage: StorageBackend, tmp_dir: str, workers: int = 2):
+        self.storage = storage
+        self.tmp_dir = tmp_dir
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+
+    async def _store_variants(self, incoming: IncomingFile, work_dir: str) -> None:
+        loop = asyncio.get_running_loop()
+        # 同じ画像が同時にアップロードされても衝突しないよう、アップロードごとの
+        # 作業ディレクトリに作る（保存先のキーはファイル名から決まる）
+        dest_base = os.path.join(work_dir, incoming.digest)
+        try:
+            paths = await loop.run_in_executor(self._executor, make_variants, incoming.path, dest_base)
+        except UploadError:
+            raise
+        except Exception as e:
+            # 縮小版の作成に失敗しても原本は使えるようにする
+            logger.warning(f"Failed to create variants for {incoming.filename}: {e!r}")
+            return
+        for path in paths:
+            key = shard_key(os.path.basename(path))
+            await self.storage.put_file(key, path, "image/webp")
+
+    async def save(self, request: Request) -> dict:
+        incoming = await receive_upload(request, self.tmp_dir)
+        key = shard_key(incoming.filename)
+        work_dir = tempfile.mkdtemp(dir=self.tmp_dir, prefix=f"{incoming.digest[:8]}-")
+        try:
+            duplicate = await self.storage.exists(key)
+            if not duplicate:
+                await self._store_variants(incoming, work_dir)
+                await self.storage.put_file(key, incoming.path, incoming.content_type)
+        finally:
+            # 保存済み（移動・アップロード済み）でなければ一時ファイルを消す
+            if os.path.exists(incoming.path):
+                os.unlink(incoming.path)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        variants = {}
+        for suffix, _ in IMAGE_VARIANTS:
+            variant_key = shard_key(f"{incoming.digest}_{suffix}.webp")
+            if await self.storage.exists(variant_key):
+                variants[suffix] = self.storage.url_for(variant_key)
+        return {
+            "filename": incoming.filename,
+            "location": self.storage.url_for(key),
+            "content_type": incoming.content_type,
+            "size": incoming.size,
+            "duplicate": duplicate,
+            "variants": variants,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.storage.close()
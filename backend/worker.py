@@ -0,0 +1,197 @@
+"""ポエム生成ジョブのワーカー
+
+`/generate-poem?mode=job` で積まれたジョブを jobs.db から取り出して生成し、
+結果をキューに書き戻す。`callback_url` があれば結果をPOSTで通知する。
+
+    python worker.py --processes 2 --concurrency 4
+
+生成は推論APIの待ちがほとんどなので、1プロセスの中で `--concurrency` 件を
+並行に処理し、プロセス数でスケールさせる。
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+import httpx
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+from jobs import CallbackURLError, check_callback_url
+
+logger = logging.getLogger("worker")
+
+# この状態コードで失敗したジョブは時間をおいて再試行する
+RETRYABLE_STATUS = {429, 503}
+RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', '5'))
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.2'))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION_SECONDS', str(24 * 3600)))
+CALLBACK_TIMEOUT = float(os.getenv('JOB_CALLBACK_TIMEOUT', '10'))
+CALLBACK_ATTEMPTS = int(os.getenv('JOB_CALLBACK_ATTEMPTS', '3'))
+CALLBACK_SECRET = os.getenv('JOB_CALLBACK_SECRET')
+CALLBACK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv('JOB_CALLBACK_ALLOWED_HOSTS', '').split(',') if h.strip()}
+
+
+async def deliver_callback(client: httpx.AsyncClient, url: str, body: dict) -> None:
+    """結果を callback_url に通知する（失敗しても結果は /jobs/{id} で取得できる）"""
+    # 受付後に DNS が書き換えられることもあるので送信直前にも確認する
+    # （リダイレクトは追わないので、その先が内部のアドレスになることはない）
+    try:
+        addresses = await asyncio.to_thread(check_callback_url, url, CALLBACK_ALLOWED_HOSTS)
+    except CallbackURLError as e:
+        logger.warning(f"Skipping callback for job {body['job_id']}: {e}")
+        return
+
+    content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json", "X-Job-Id": body["job_id"]}
+    target, extensions = httpx.URL(url), {}
+    if addresses:
+        # httpx に名前解決し直させると確認後に DNS を差し替えられるので、確認したアドレスに
+        # 直接接続する。Host ヘッダーと TLS の SNI・証明書の検証には元のホスト名を使う
+        headers["Host"] = target.netloc.decode("ascii")
+        extensions["sni_hostname"] = target.raw_host.decode("ascii")
+        target = target.copy_with(host=addresses[0])
+    if CALLBACK_SECRET:
+        signature = hmac.new(CALLBACK_SECRET.encode(), content, hashlib.sha256).hexdigest()
+        headers["X-Signature"] = f"sha256={signature}"
+
+    for attempt in range(CALLBACK_ATTEMPTS):
+        try:
+            response = await client.post(target, content=content, headers=headers, extensions=extensions)
+            if response.status_code < 500:
+                if response.status_code >= 400:
+                    logger.warning(f"Callback for job {body['job_id']} rejected: {response.status_code}")
+                return
+            logger.warning(f"Callback for job {body['job_id']} returned {response.status_code}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Callback for job {body['job_id']} failed: {e!r}")
+        await asyncio.sleep(2 ** attempt)
+    logger.error(f"Giving up callback for job {body['job_id']} to {url}")
+
+
+class Worker:
+    def __init__(self, api, concurrency: int):
+        self.api = api
+        self.queue = api.job_queue
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.stopping = asyncio.Event()
+        self.callbacks = httpx.AsyncClient(timeout=CALLBACK_TIMEOUT)
+
+    async def process(self, job: dict) -> None:
+        job_id = job["id"]
+        try:
+            poem = await self.api.create_poem(self.api.PoemRequest(**job["payload"]))
+            # PostgreSQL の行は datetime を含むので JSON にできる形にしてから保存する
+            await asyncio.to_thread(self.queue.complete, job_id, jsonable_encoder(poem))
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.queue.release, job_id)
+            raise
+        except HTTPException as e:
+            retry_after = RETRY_DELAY * 2 ** (job["attempts"] - 1) if e.status_code in RETRYABLE_STATUS else None
+            if await asyncio.to_thread(self.queue.fail, job_id, str(e.detail), retry_after):
+                logger.info(f"Job {job_id} requeued after {e.status_code}")
+                return
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e!r}")
+            await asyncio.to_thread(self.queue.fail, job_id, str(e))
+
+        if job["callback_url"]:
+            finished = await asyncio.to_thread(self.queue.get, job_id)
+            await deliver_callback(self.callbacks, job["callback_url"], self.api.public_job(finished))
+
+    async def _idle(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def slot(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                job = await asyncio.to_thread(self.queue.claim, self.worker_id)
+                if job is None:
+                    await self._idle(POLL_INTERVAL)
+                    continue
+                await self.process(job)
+            except Exception as e:
+                # キューの書き込み失敗などでワーカー全体を止めない
+                # （ジョブはリースが切れると再投入される）
+                logger.error(f"Worker slot error: {e!r}", exc_info=True)
+                await self._idle(POLL_INTERVAL)
+
+    async def purge(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                removed = await asyncio.to_thread(self.queue.purge, JOB_RETENTION)
+                if removed:
+                    logger.info(f"Purged {removed} finished jobs")
+            except Exception as e:
+                logger.error(f"Failed to purge finished jobs: {e!r}")
+            await self._idle(600)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        await self.api.startup()
+        logger.info(f"Worker {self.worker_id} started with concurrency {self.concurrency}")
+        try:
+            # 停止シグナルを受けたら新しいジョブは取らず、処理中のものは終わらせる
+            await asyncio.gather(self.purge(), *(self.slot() for _ in range(self.concurrency)))
+        finally:
+            await self.callbacks.aclose()
+            await self.api.shutdown()
+            logger.info(f"Worker {self.worker_id} stopped")
+
+
+async def _run_worker(concurrency: int) -> None:
+    # main は import 時にキューやセマフォを作るので、Python 3.9 ではそれらが
+    # このループに紐づくよう asyncio.run の中で import して Worker を作る
+    import main as api
+
+    await Worker(api, concurrency).run()
+
+
+def run_worker(concurrency: int) -> None:
+    asyncio.run(_run_worker(concurrency))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=int(os.getenv('JOB_WORKER_PROCESSES', '2')))
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv('JOB_WORKER_CONCURRENCY', '4')))
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(args.concurrency)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.concurrency,), name=f"poem-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
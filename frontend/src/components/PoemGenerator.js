@@ -37,13 +37,48 @@ const PoemGenerator = () => {
     severity: 'success'
   });
 
-  useEffect(() => {
-    if (location.state?.imageData || location.state?.characterData) {
-      generatePoem();
+  // トークンをServer-Sent Eventsで受け取り、届いた分から表示する
+  const streamPoem = async (requestData, signal) => {
+    const response = await fetch(`${API_URL}/generate-poem/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(requestData),
+      signal
+    });
+    if (!response.ok || !response.body) {
+      throw new Error(`stream failed: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let content = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const events = buffer.split('\n\n');
+      buffer = events.pop();
+      for (const raw of events) {
+        const event = raw.match(/^event: (.*)$/m)?.[1];
+        const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || '{}');
+        if (event === 'token') {
+          content += data.text;
+          setPoem({ content });
+          setLoading(false);
+        } else if (event === 'done') {
+          return { id: data.id, content: data.content };
+        } else if (event === 'error') {
+          throw new Error(data.detail);
+        }
+      }
     }
-  }, [location.state, generatePoem, navigate]);
+    throw new Error('stream ended before completion');
+  };
 
-  const generatePoem = async () => {
+  const generatePoem = async (signal) => {
     setLoading(true);
     try {
       const source = location.state.imageData ? 'image' : 'character';
@@ -53,11 +88,20 @@ const PoemGenerator = () => {
         characterData: location.state.characterData
       };
 
-      const response = await axios.post(`${API_URL}/generate-poem`, requestData);
+      let generated;
+      try {
+        generated = await streamPoem(requestData, signal);
+      } catch (error) {
+        if (signal?.aborted) return;
+        // ストリーミングが使えない場合は従来のエンドポイントにフォールバック
+        const response = await axios.post(`${API_URL}/generate-poem`, requestData, { signal });
+        generated = response.data.poem;
+      }
 
-      setPoem(response.data.poem);
-      setEditedContent(response.data.poem.content);
+      setPoem(generated);
+      setEditedContent(generated.content);
     } catch (error) {
+      if (signal?.aborted) return;
       setSnackbar({
         open: true,
         message: 'ポエムの生成に失敗しました',
@@ -68,6 +112,15 @@ const PoemGenerator = () => {
     }
   };
 
+  useEffect(() => {
+    if (location.state?.imageData || location.state?.characterData) {
+      // 画面を離れたら生成を中断し、サーバー側の生成も止める
+      const controller = new AbortController();
+      generatePoem(controller.signal);
+      return () => controller.abort();
+    }
+  }, [location.state]); // eslint-disable-line react-hooks/exhaustive-deps
+
   const handleEdit = () => {
     setEditing(true);
   };